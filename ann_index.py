@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Chỉ mục tìm láng giềng gần đúng (ANN) thuần NumPy cho embeddings đã chuẩn hóa.
+
+IVF (inverted file): k-means cầu (cosine) chia items thành n_lists cụm; khi truy vấn chỉ quét
+n_probe cụm gần nhất. n_probe càng lớn thì recall càng cao và càng chậm; n_probe >= n_lists
+tương đương quét toàn bộ (brute-force).
+"""
+
+import numpy as np
+from pathlib import Path
+
+class IVFIndex:
+    def __init__(self, n_lists=None, n_probe=8, n_iter=10, train_size=None, seed=0):
+        """
+        Parameters:
+        - n_lists: số cụm thô, mặc định ~sqrt(số items)
+        - n_probe: số cụm được quét mỗi truy vấn (nút chỉnh recall/độ trễ)
+        - n_iter: số vòng lặp k-means
+        - train_size: số vector dùng để huấn luyện k-means, mặc định 256 * n_lists
+        - seed: seed cho khởi tạo k-means
+        """
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.train_size = train_size
+        self.seed = seed
+        self.ids = None
+        self.centroids = None
+        self.vectors = None
+        self.order = None
+        self.offsets = None
+
+    @staticmethod
+    def _normalize(matrix):
+        matrix = np.asarray(matrix, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return np.ascontiguousarray(matrix / norms)
+
+    @staticmethod
+    def _assign(vectors, centroids, chunk_size=65536):
+        """
+        Gán mỗi vector vào centroid có cosine lớn nhất, xử lý theo khối để giới hạn bộ nhớ.
+        """
+        assign = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), chunk_size):
+            assign[start:start + chunk_size] = np.argmax(vectors[start:start + chunk_size] @ centroids.T, axis=1)
+        return assign
+
+    def _kmeans(self, vectors, rng):
+        centroids = vectors[rng.choice(len(vectors), self.n_lists, replace=False)].copy()
+        for _ in range(self.n_iter):
+            assign = self._assign(vectors, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, vectors)
+            empty = np.bincount(assign, minlength=self.n_lists) == 0
+            # Cụm rỗng được khởi tạo lại bằng một vector ngẫu nhiên
+            sums[empty] = vectors[rng.choice(len(vectors), empty.sum())]
+            centroids = self._normalize(sums)
+        return centroids
+
+    def build(self, vectors, ids=None):
+        """
+        Xây dựng chỉ mục.
+
+        Parameters:
+        - vectors: ma trận (n_items, d), sẽ được chuẩn hóa L2
+        - ids: mảng id tương ứng với các hàng, mặc định là chỉ số hàng
+        """
+        vectors = self._normalize(vectors)
+        n = len(vectors)
+        self.ids = np.arange(n) if ids is None else np.asarray(ids)
+        if self.n_lists is None:
+            self.n_lists = max(1, int(np.sqrt(n)))
+        self.n_lists = min(self.n_lists, n)
+
+        rng = np.random.default_rng(self.seed)
+        train_size = self.train_size or 256 * self.n_lists
+        train = vectors if train_size >= n else vectors[rng.choice(n, train_size, replace=False)]
+        self.centroids = self._kmeans(train, rng)
+
+        assign = self._assign(vectors, self.centroids)
+        self.order = np.argsort(assign, kind='stable')
+        self.vectors = vectors[self.order]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=self.n_lists))])
+        print(f"Built IVF index: {n} items, {self.n_lists} lists")
+        return self
+
+    def _brute_force(self, queries, k):
+        scores = queries @ self.vectors.T
+        return self._top_k(scores, np.broadcast_to(self.order, scores.shape), k)
+
+    @staticmethod
+    def _top_k(scores, positions, k):
+        """
+        Lấy top-k theo từng hàng, đệm -1 / -inf khi không đủ ứng viên.
+        """
+        n_rows, n_candidates = scores.shape
+        out_pos = np.full((n_rows, k), -1, dtype=np.int64)
+        out_scores = np.full((n_rows, k), -np.inf, dtype=np.float32)
+        kk = min(k, n_candidates)
+        if kk == 0:
+            return out_pos, out_scores
+        top = np.argpartition(-scores, kk - 1, axis=1)[:, :kk] if kk < n_candidates \
+            else np.broadcast_to(np.arange(n_candidates), scores.shape)
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        out_pos[:, :kk] = np.take_along_axis(np.take_along_axis(positions, top, axis=1), order, axis=1)
+        out_scores[:, :kk] = np.take_along_axis(top_scores, order, axis=1)
+        return out_pos, out_scores
+
+    def search(self, queries, k, n_probe=None, exact=False):
+        """
+        Tìm k items gần nhất (cosine) cho mỗi truy vấn.
+
+        Parameters:
+        - queries: ma trận (n_queries, d)
+        - k: số láng giềng
+        - n_probe: ghi đè self.n_probe cho lần truy vấn này
+        - exact: True để quét toàn bộ (brute-force)
+
+        Returns:
+        - positions: (n_queries, k) chỉ số hàng trong ma trận gốc (ids[positions] là id), -1 nếu thiếu
+        - scores: (n_queries, k) cosine tương ứng, -inf nếu thiếu
+        """
+        queries = self._normalize(np.atleast_2d(queries))
+        n_probe = self.n_probe if n_probe is None else n_probe
+        if exact or n_probe >= self.n_lists:
+            return self._brute_force(queries, k)
+
+        probes = np.argpartition(-(queries @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+        positions = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        # Duyệt theo cụm: mỗi cụm chỉ cần một phép GEMM với các truy vấn quét nó, rồi gộp vào top-k hiện tại
+        query_rows, list_ids = np.repeat(np.arange(len(queries)), n_probe), probes.ravel()
+        by_list = np.argsort(list_ids, kind='stable')
+        query_rows, list_ids = query_rows[by_list], list_ids[by_list]
+        bounds = np.searchsorted(list_ids, np.arange(self.n_lists + 1))
+        for l in range(self.n_lists):
+            rows = query_rows[bounds[l]:bounds[l + 1]]
+            start, end = self.offsets[l], self.offsets[l + 1]
+            if not len(rows) or start == end:
+                continue
+            list_scores = queries[rows] @ self.vectors[start:end].T
+            merged_scores = np.concatenate([scores[rows], list_scores], axis=1)
+            merged_pos = np.concatenate([positions[rows], np.broadcast_to(self.order[start:end], list_scores.shape)], axis=1)
+            positions[rows], scores[rows] = self._top_k(merged_scores, merged_pos, k)
+        return positions, scores
+
+    def save(self, save_dir='data_save/embeddings'):
+        """Lưu chỉ mục cạnh embeddings"""
+        Path(save_dir).mkdir(parents=True, exist_ok=True)
+        np.savez(f'{save_dir}/ann_index.npz', ids=self.ids, centroids=self.centroids, vectors=self.vectors,
+                 order=self.order, offsets=self.offsets, n_probe=self.n_probe)
+        print(f"Saved ANN index to {save_dir}")
+
+    @classmethod
+    def load(cls, load_dir='data_save/embeddings'):
+        """Tải chỉ mục đã lưu, trả về None nếu chưa có"""
+        try:
+            data = np.load(f'{load_dir}/ann_index.npz', allow_pickle=False)
+        except FileNotFoundError:
+            print("No saved ANN index found")
+            return None
+
+        index = cls(n_lists=len(data['centroids']), n_probe=int(data['n_probe']))
+        index.ids = data['ids']
+        index.centroids = data['centroids']
+        index.vectors = data['vectors']
+        index.order = data['order']
+        index.offsets = data['offsets']
+        print(f"Loaded ANN index for {len(index.ids)} items")
+        return index
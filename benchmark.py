@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark toàn bộ pipeline trên dữ liệu giả lập cùng schema với assistment_2012_2013.csv.
+
+Mỗi quy mô (scale) chạy trong một process riêng để peak RSS không bị lẫn giữa các lần đo. Các giai đoạn:
+preprocessing_matrix, preprocessing_meta_data.process, sinh embedding (encoder giả, không cần mạng),
+_build_user_profiles, fit MF, recommend và một vòng Co-Training. Kết quả (thời gian, throughput,
+peak RSS theo từng quy mô) được ghi ra JSON để so sánh giữa các phiên bản.
+
+Ví dụ:
+    python benchmark.py --users 5000 --sequences 1000 --rows 500000 --scales 0.25 0.5 1 --output benchmark.json
+"""
+
+import argparse
+import json
+import platform
+import resource
+import sys
+import tempfile
+import time
+import zlib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import get_context
+from pathlib import Path
+from preprocessing import preprocessing_matrix, preprocessing_meta_data
+from item_embedding import ItemEmbeddingGenerator
+from content_based import ContentBasedRecommender
+from matrix_factorization import MatrixFactorizationRecommender
+from co_training import CoTrainingRecommender
+import metrics
+
+SKILLS = ['Addition and Subtraction Integers', 'Addition and Subtraction Fractions', 'Multiplication and Division Integers',
+          'Equation Solving Two or Fewer Steps', 'Equation Solving More Than Two Steps', 'Order of Operations All',
+          'Pythagorean Theorem', 'Area Rectangle', 'Circle Graph', 'Venn Diagram', 'Probability of a Single Event',
+          'Percent Of', 'Proportion', 'Scientific Notation', 'Square Root', 'Pattern Finding', 'Median', 'Mode',
+          'Range', 'Mean', 'Ordering Fractions', 'Least Common Multiple', 'Greatest Common Factor',
+          'Absolute Value', 'Exponents', 'Rounding', 'Unit Conversion Within a System', 'Angles on Parallel Lines',
+          'Surface Area Rectangular Prism', 'Volume Cylinder']
+PROBLEM_TYPES = np.array(['algebra', 'choose_1', 'fill_in_1', 'open_response', 'choose_n', 'rank'])
+PROBLEM_TYPE_WEIGHTS = np.array([0.45, 0.25, 0.15, 0.1, 0.04, 0.01])
+SECTION_TYPES = np.array(['LinearSection', 'MasterySection', 'RandomIterateSection'])
+
+def _zipf_weights(n, skew):
+    weights = 1.0 / np.arange(1, n + 1) ** skew
+    return weights / weights.sum()
+
+def generate_assistments(file_path, n_users=5000, n_sequences=1000, n_rows=500_000, skew=1.1, seed=0):
+    """
+    Ghi một file CSV cùng các cột với assistment_2012_2013.csv.
+
+    Mức độ hoạt động của users và độ phổ biến của sequences theo phân phối Zipf (skew); mỗi sequence
+    có vài problems cùng skill, kiểu section cố định, và xác suất đúng phụ thuộc năng lực user
+    và độ khó sequence nên ma trận rating có tín hiệu thật.
+    """
+    rng = np.random.default_rng(seed)
+    users = rng.permutation(n_users)[rng.choice(n_users, n_rows, p=_zipf_weights(n_users, skew))] + 1
+    sequences = rng.permutation(n_sequences)[rng.choice(n_sequences, n_rows, p=_zipf_weights(n_sequences, skew))]
+
+    problems_per_sequence = rng.integers(3, 16, n_sequences)
+    first_problem = np.concatenate([[0], np.cumsum(problems_per_sequence)[:-1]])
+    position = (rng.random(n_rows) * problems_per_sequence[sequences]).astype(np.int64)
+    problems = first_problem[sequences] + position
+    n_problems = int(problems_per_sequence.sum())
+
+    sequence_skill = rng.integers(0, len(SKILLS), n_sequences)
+    problem_skill = np.where(rng.random(n_problems) < 0.8, np.repeat(sequence_skill, problems_per_sequence),
+                             rng.integers(0, len(SKILLS), n_problems))
+    skills = np.array(SKILLS + [None], dtype=object)[np.where(rng.random(n_problems) < 0.1, len(SKILLS), problem_skill)]
+    problem_type = rng.choice(len(PROBLEM_TYPES), n_problems, p=PROBLEM_TYPE_WEIGHTS)
+    section_type = np.array(list(SECTION_TYPES) + [None], dtype=object)[
+        np.where(rng.random(n_sequences) < 0.01, len(SECTION_TYPES), rng.integers(0, len(SECTION_TYPES), n_sequences))]
+
+    ability = rng.normal(0, 1, n_users + 1)
+    difficulty = rng.normal(0, 1, n_sequences)
+    correct = (rng.random(n_rows) < 1 / (1 + np.exp(difficulty[sequences] - ability[users]))).astype(np.int64)
+
+    start_time = pd.Timestamp('2012-09-01') + pd.to_timedelta(rng.integers(0, 300 * 86400, n_rows), unit='s')
+    duration = pd.to_timedelta(rng.integers(5, 600, n_rows), unit='s')
+    teachers = rng.integers(0, max(1, n_users // 50), n_users + 1)
+    df = pd.DataFrame({
+        'problem_log_id': np.arange(n_rows) + 1,
+        'skill': skills[problems],
+        'problem_id': problems + 1,
+        'user_id': users,
+        'assignment_id': sequences * 7 + teachers[users] % 7,
+        'assistment_id': problems + 100_000,
+        'start_time': start_time,
+        'end_time': start_time + duration,
+        'problem_type': PROBLEM_TYPES[problem_type[problems]],
+        'original': (rng.random(n_rows) < 0.9).astype(np.int64),
+        'correct': correct,
+        'bottom_hint': np.where(correct == 0, rng.integers(0, 2, n_rows), 0),
+        'hint_count': np.where(correct == 0, rng.integers(0, 4, n_rows), 0),
+        'actions': rng.integers(1, 8, n_rows),
+        'attempt_count': np.where(correct == 1, 1, rng.integers(1, 5, n_rows)),
+        'ms_first_response': rng.integers(1000, 120_000, n_rows),
+        'tutor_mode': 'tutor',
+        'answer_type': PROBLEM_TYPES[problem_type[problems]],
+        'sequence_id': sequences + 1,
+        'student_class_id': teachers[users] * 3 + users % 3,
+        'position': position + 1,
+        'type': section_type[sequences],
+        'base_sequence_id': sequences + 1,
+        'skill_id': problem_skill[problems] + 1,
+        'teacher_id': teachers[users] + 1,
+        'school_id': teachers[users] // 10 + 1,
+        'overlap_time': duration.total_seconds().astype(np.int64) * 1000,
+        'template_id': problems // 3 + 1,
+        'answer_id': np.where(PROBLEM_TYPES[problem_type[problems]] == 'choose_1', rng.integers(1, 5, n_rows), 0),
+        'answer_text': np.where(correct == 1, 'correct answer', 'wrong answer'),
+        'first_action': rng.integers(0, 3, n_rows),
+    })
+    df.to_csv(file_path, index=False)
+    return file_path
+
+class HashingEncoder:
+    def __init__(self, dimension=384):
+        """
+        Encoder giả thay cho SentenceTransformer để benchmark chạy offline: túi từ được băm (crc32)
+        vào `dimension` chiều rồi chuẩn hóa, nên các prompt giống nhau vẫn có embedding gần nhau.
+        """
+        self.dimension = dimension
+
+    def encode(self, texts, **kwargs):
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            columns = [zlib.crc32(token.encode('utf-8')) % self.dimension for token in text.split()]
+            np.add.at(vectors[row], columns, 1.0)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+def peak_rss_mb():
+    # ru_maxrss là KB trên Linux, byte trên macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+@contextmanager
+def _stage(stages, name, unit):
+    """
+    Đo thời gian một giai đoạn; gán record['count'] trong khối with để tính throughput (unit/s).
+    """
+    record = {'unit': unit, 'count': None}
+    start = time.perf_counter()
+    yield record
+    record['seconds'] = time.perf_counter() - start
+    record['throughput'] = record['count'] / record['seconds'] if record['count'] and record['seconds'] > 0 else None
+    record['peak_rss_mb'] = peak_rss_mb()
+    stages[name] = record
+    print(f"  {name}: {record['seconds']:.3f}s ({record['count']} {unit})")
+
+def run_scale(n_users, n_sequences, n_rows, skew=1.1, seed=0, backend='svd', n_factors=50, embedding_dim=384,
+              recommend_users=1000, top_n=10, candidate_k=None, confidence_threshold=0.8, work_dir=None):
+    """
+    Chạy tất cả các giai đoạn ở một quy mô, trả về dict kết quả (kèm số liệu chi tiết của metrics).
+    """
+    metrics.reset()
+    metrics.enable()
+    stages = {}
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        file_path = f'{tmp_dir}/assistment_synthetic.csv'
+        with _stage(stages, 'generate', 'rows') as record:
+            generate_assistments(file_path, n_users, n_sequences, n_rows, skew, seed)
+            record['count'] = n_rows
+
+        with _stage(stages, 'preprocessing_matrix', 'rows') as record:
+            pre = preprocessing_matrix(file_path=file_path)
+            pre.reverse_correct()
+            pre.filter_matrix()
+            record['count'] = n_rows
+        ratings_df = pre.df
+        sequence_ids = pre.extract_sequence_id()
+
+        with _stage(stages, 'meta_data_process', 'rows') as record:
+            items = preprocessing_meta_data(file_path=file_path, sequence_id_list=sequence_ids).process()
+            record['count'] = n_rows
+
+    with _stage(stages, 'embedding', 'items') as record:
+        generator = ItemEmbeddingGenerator(output_dimension=embedding_dim, cache_dir=None,
+                                           model=HashingEncoder(embedding_dim))
+        embeddings = generator.generate_item_embeddings(items)
+        record['count'] = len(embeddings)
+
+    content = ContentBasedRecommender(embeddings, ratings_df)
+    with _stage(stages, 'build_user_profiles', 'ratings') as record:
+        content._build_user_profiles()
+        record['count'] = len(ratings_df)
+
+    with _stage(stages, 'mf_fit', 'ratings') as record:
+        mf = MatrixFactorizationRecommender(ratings_df, n_factors=n_factors, backend=backend)
+        record['count'] = len(ratings_df)
+
+    users = content.user_ids[:recommend_users]
+    with _stage(stages, 'recommend_content', 'users') as record:
+        content.recommend_batch(users, top_n)
+        record['count'] = len(users)
+    with _stage(stages, 'recommend_mf', 'users') as record:
+        mf.recommend_batch(users, top_n)
+        record['count'] = len(users)
+
+    co_training = CoTrainingRecommender(content, mf, ratings_df, batch_size=100_000, candidate_k=candidate_k)
+    with _stage(stages, 'co_training_round', 'pairs') as record:
+        co_training.co_training(max_iter=1, confidence_threshold=confidence_threshold)
+        # Số cặp thực sự được chấm (ứng viên đã quyết định bị bỏ qua, không tính vào thông lượng)
+        record['count'] = co_training.history[-1]['scored']
+
+    return {'n_users': n_users, 'n_sequences': n_sequences, 'n_rows': n_rows,
+            'n_ratings': len(ratings_df), 'n_items': len(embeddings), 'stages': stages, 'metrics': metrics.export()}
+
+def run_benchmark(n_users=5000, n_sequences=1000, n_rows=500_000, scales=(0.25, 0.5, 1.0), compare_als=False,
+                  output=None, **params):
+    """
+    Chạy run_scale cho từng hệ số quy mô (nhân với users, sequences, rows), mỗi lần trong một process mới,
+    và trả về (tùy chọn ghi ra output) báo cáo JSON gồm đường cong theo quy mô của mỗi giai đoạn.
+    """
+    runs = []
+    for scale in scales:
+        sizes = (max(1, int(n_users * scale)), max(1, int(n_sequences * scale)), max(1, int(n_rows * scale)))
+        print(f"Scale {scale}: {sizes[0]} users, {sizes[1]} sequences, {sizes[2]} rows")
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+            result = executor.submit(run_scale, *sizes, **params).result()
+        result['scale'] = scale
+        runs.append(result)
+
+    curves = {stage: [{'scale': run['scale'], 'n_rows': run['n_rows'], 'seconds': run['stages'][stage]['seconds'],
+                       'throughput': run['stages'][stage]['throughput'], 'peak_rss_mb': run['stages'][stage]['peak_rss_mb']}
+                      for run in runs]
+              for stage in runs[0]['stages']} if runs else {}
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                        'machine': platform.machine(), 'processor': platform.processor()},
+        'params': {'n_users': n_users, 'n_sequences': n_sequences, 'n_rows': n_rows, 'scales': list(scales), **params},
+        'runs': runs,
+        'curves': curves,
+    }
+
+    if compare_als:
+        from als import compare_with_svd
+        largest = runs[-1]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = generate_assistments(f'{tmp_dir}/assistment_synthetic.csv', largest['n_users'],
+                                             largest['n_sequences'], largest['n_rows'], params.get('skew', 1.1),
+                                             params.get('seed', 0))
+            pre = preprocessing_matrix(file_path=file_path)
+            pre.reverse_correct()
+            pre.filter_matrix()
+        report['als_vs_svd'] = compare_with_svd(pre.df, n_factors=params.get('n_factors', 50))
+
+    if output is not None:
+        Path(output).write_text(json.dumps(report, indent=2))
+        print(f"Saved benchmark report to {output}")
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--sequences', type=int, default=1000)
+    parser.add_argument('--rows', type=int, default=500_000)
+    parser.add_argument('--scales', type=float, nargs='+', default=[0.25, 0.5, 1.0])
+    parser.add_argument('--skew', type=float, default=1.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', choices=['svd', 'als'], default='svd')
+    parser.add_argument('--n-factors', type=int, default=50)
+    parser.add_argument('--embedding-dim', type=int, default=384)
+    parser.add_argument('--candidate-k', type=int, default=None)
+    parser.add_argument('--compare-als', action='store_true')
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args()
+
+    run_benchmark(args.users, args.sequences, args.rows, args.scales, compare_als=args.compare_als, output=args.output,
+                  skew=args.skew, seed=args.seed, backend=args.backend, n_factors=args.n_factors,
+                  embedding_dim=args.embedding_dim, candidate_k=args.candidate_k)
@@ -6,11 +6,304 @@ Created on Sun Feb 23 15:12:41 2025
 @author: rcyuh
 """
 
+import json
+import os
+import time
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from pathlib import Path
+from preprocessing import save_npz
+from utils import mf_estimate
+import metrics
+
+class UnlabeledSet:
+    def __init__(self, user_ids, item_ids, max_chunks=8):
+        """
+        Tập không có nhãn (U) biểu diễn ngầm: U = (tất cả users x tất cả items) - các cặp đã quyết định.
+        
+        Parameters:
+        - user_ids, item_ids: các cặp (user, item) đã có nhãn trong dữ liệu gốc
+        - max_chunks: số mảng khóa đã sắp xếp tối đa trước khi gộp lại
+        
+        Users và items được đánh chỉ số nguyên theo thứ tự xuất hiện, mỗi cặp được mã hóa thành
+        khóa user_idx * n_items + item_idx. Các cặp đã quyết định được lưu thành danh sách các mảng
+        khóa đã sắp xếp; mỗi lần loại bỏ chỉ thêm một mảng mới nên chi phí là O(batch).
+        """
+        user_idx, self.users = pd.factorize(np.asarray(user_ids))
+        item_idx, self.items = pd.factorize(np.asarray(item_ids))
+        self.n_users = len(self.users)
+        self.n_items = len(self.items)
+        self.max_chunks = max_chunks
+        
+        observed = np.unique(self.encode(user_idx, item_idx))
+        self._decided = [observed]
+        self._n_decided = len(observed)
+    
+    @classmethod
+    def from_chunks(cls, n_users, n_items, decided, max_chunks=8):
+        """
+        Dựng lại U từ kích thước và các mảng khóa đã quyết định, không cần id gốc
+        (dùng trong process worker, nơi các mảng khóa nằm ở shared memory).
+        """
+        U = cls.__new__(cls)
+        U.users = U.items = None
+        U.n_users, U.n_items = n_users, n_items
+        U.max_chunks = max_chunks
+        U._decided = list(decided)
+        U._n_decided = sum(len(chunk) for chunk in U._decided)
+        return U
+    
+    def __len__(self):
+        return self.n_users * self.n_items - self._n_decided
+    
+    def encode(self, user_idx, item_idx):
+        """
+        Mã hóa cặp chỉ số (user, item) thành khóa int64.
+        """
+        return np.asarray(user_idx, dtype=np.int64) * self.n_items + np.asarray(item_idx, dtype=np.int64)
+    
+    def decode(self, keys):
+        """
+        Giải mã khóa int64 thành cặp chỉ số (user, item).
+        """
+        return np.divmod(keys, self.n_items)
+    
+    def contains(self, keys):
+        """
+        Trả về mask cho biết các khóa nào vẫn còn trong U.
+        """
+        decided = np.zeros(len(keys), dtype=bool)
+        for chunk in self._decided:
+            if not len(chunk):
+                continue
+            pos = np.searchsorted(chunk, keys)
+            pos[pos == len(chunk)] = 0
+            decided |= chunk[pos] == keys
+        return ~decided
+    
+    def iter_blocks(self, block_size, candidates=None, user_bounds=None):
+        """
+        Sinh lần lượt các khối ứng viên (user_idx, item_idx) theo thứ tự user rồi item.
+        
+        Mỗi khối gồm trọn vẹn một số user liên tiếp (khoảng block_size cặp trước khi lọc).
+        
+        Parameters:
+        - block_size: số cặp ứng viên xấp xỉ mỗi khối
+        - candidates: (tùy chọn) mảng (n_users, k) chỉ số items ứng viên cho từng user, -1 là ô trống;
+          None thì xét tất cả items
+        - user_bounds: (tùy chọn) (start, end) chỉ duyệt các user_idx trong [start, end)
+        """
+        n_columns = self.n_items if candidates is None else candidates.shape[1]
+        users_per_block = max(1, block_size // max(n_columns, 1))
+        item_range = np.arange(self.n_items, dtype=np.int64)
+        first, last = user_bounds if user_bounds is not None else (0, self.n_users)
+        for user_start in range(first, last, users_per_block):
+            user_range = np.arange(user_start, min(user_start + users_per_block, last), dtype=np.int64)
+            if candidates is None:
+                keys = (user_range[:, None] * self.n_items + item_range[None, :]).ravel()
+            else:
+                block = candidates[user_range]
+                keys = (user_range[:, None] * self.n_items + block)[block >= 0]
+            keys = keys[self.contains(keys)]
+            if len(keys):
+                yield self.decode(keys)
+    
+    def remove(self, user_idx, item_idx):
+        """
+        Loại các cặp đã được gán nhãn giả khỏi U.
+        """
+        keys = np.unique(self.encode(user_idx, item_idx))
+        keys = keys[self.contains(keys)]
+        if not len(keys):
+            return
+        self._decided.append(keys)
+        self._n_decided += len(keys)
+        if len(self._decided) > self.max_chunks:
+            self._decided = [np.sort(np.concatenate(self._decided))]
+
+class SharedArrays:
+    _attached = {}  # Trong mỗi process worker: tên segment -> SharedMemory đang gắn
+    
+    def __init__(self, arrays):
+        """
+        Sao chép các mảng NumPy vào multiprocessing.shared_memory để các process worker đọc trực tiếp,
+        không pickle và không sao chép thêm.
+        
+        Parameters:
+        - arrays: dict {tên: np.ndarray}
+        
+        spec (dict {tên: (tên segment, shape, dtype)}) là thứ duy nhất cần gửi sang worker.
+        Chỉ process tạo ra mới giải phóng segment (close sẽ unlink).
+        """
+        self._segments = []
+        self.spec = {}
+        for key, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            segment = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, array.dtype, buffer=segment.buf)[...] = array
+            self._segments.append(segment)
+            self.spec[key] = (segment.name, array.shape, array.dtype.str)
+    
+    @classmethod
+    def attach(cls, spec):
+        """
+        Trả về dict {tên: np.ndarray} trỏ vào các segment của spec. Segment được gắn một lần cho mỗi
+        process; các segment của spec cũ (vòng trước) được đóng lại.
+        """
+        names = {name for name, _, _ in spec.values()}
+        for name in list(cls._attached):
+            if name not in names:
+                cls._attached.pop(name).close()
+        
+        arrays = {}
+        for key, (name, shape, dtype) in spec.items():
+            if name not in cls._attached:
+                # Worker dùng chung resource_tracker với process cha, nên segment chỉ bị thu hồi khi cha unlink
+                cls._attached[name] = shared_memory.SharedMemory(name=name)
+            arrays[key] = np.ndarray(shape, dtype, buffer=cls._attached[name].buf)
+        return arrays
+    
+    def close(self):
+        for segment in self._segments:
+            segment.close()
+            segment.unlink()
+        self._segments = []
+
+SELECT_BY = ('user', 'item', 'global')
+
+class PseudoLabelSelector:
+    def __init__(self, confidence_threshold, top_k=None, select_by='user'):
+        """
+        Chọn nhãn giả từ các khối ứng viên đã chấm điểm, với bộ nhớ giới hạn.
+        
+        Parameters:
+        - confidence_threshold: chỉ xét các cặp có độ tin cậy vượt ngưỡng
+        - top_k: None giữ mọi cặp vượt ngưỡng; nếu đặt thì chỉ giữ top_k cặp tin cậy nhất mỗi nhóm
+        - select_by: nhóm của top_k - 'user' (mỗi user), 'item' (mỗi item) hoặc 'global' (cả vòng)
+        
+        Các cặp vượt ngưỡng được gom vào bộ đệm; khi bộ đệm lớn hơn gấp đôi số cặp đang giữ, nó được cắt
+        lại còn top_k mỗi nhóm (top_k của một hợp = top_k của hợp các top_k), nên bộ nhớ là O(ngân sách)
+        thay vì O(số ứng viên). Hòa điểm được phá theo cặp (user_idx, item_idx) nhỏ hơn để kết quả không
+        phụ thuộc thứ tự các khối hay cách chia shard.
+        """
+        if select_by not in SELECT_BY:
+            raise ValueError(f"select_by must be one of {SELECT_BY}, got {select_by}")
+        self.confidence_threshold = confidence_threshold
+        self.top_k = top_k
+        self.select_by = select_by
+        self.n_scored = 0
+        self.n_passed = 0
+        self._parts = []
+        self._kept = 0
+        self._buffered = 0
+    
+    def add_scores(self, user_idx, item_idx, r_cbf, r_mf):
+        """
+        Thêm một khối dự đoán của hai mô hình; nhãn giả là trung bình hai dự đoán.
+        """
+        self.n_scored += len(user_idx)
+        confidence = 1 - np.abs(r_cbf - r_mf) / 5  # Chuẩn hóa tin cậy về khoảng [0,1]
+        # NaN so sánh luôn False nên các cặp không dự đoán được tự động bị loại
+        accepted = confidence > self.confidence_threshold
+        self.add(user_idx[accepted], item_idx[accepted], (r_cbf[accepted] + r_mf[accepted]) / 2,
+                 confidence[accepted])
+    
+    def add(self, user_idx, item_idx, ratings, confidence, n_passed=None, n_scored=0):
+        """
+        Thêm các cặp đã vượt ngưỡng (ví dụ kết quả của một selector khác); n_passed mặc định là số cặp,
+        n_scored là số cặp đã chấm điểm để có được chúng.
+        """
+        self.n_scored += n_scored
+        self.n_passed += len(user_idx) if n_passed is None else n_passed
+        if not len(user_idx):
+            return
+        self._parts.append((user_idx, item_idx, ratings, confidence))
+        self._buffered += len(user_idx)
+        if self.top_k is not None and self._buffered > 2 * max(self._kept, self.top_k):
+            self._prune()
+    
+    def _concatenate(self):
+        if not self._parts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)
+        return tuple(np.concatenate(part) for part in zip(*self._parts))
+    
+    def _keep_mask(self, user_idx, item_idx, confidence):
+        """
+        Mask các cặp thuộc top_k của nhóm tương ứng.
+        """
+        k = self.top_k
+        if self.select_by == 'global':
+            keep = np.ones(len(confidence), dtype=bool)
+            if len(confidence) <= k:
+                return keep
+            cut = -np.partition(-confidence, k - 1)[k - 1]
+            keep = confidence > cut
+            tied = np.flatnonzero(confidence == cut)
+            tied = tied[np.lexsort((item_idx[tied], user_idx[tied]))]
+            keep[tied[:k - keep.sum()]] = True
+            return keep
+        
+        groups, others = (user_idx, item_idx) if self.select_by == 'user' else (item_idx, user_idx)
+        order = np.lexsort((others, -confidence, groups))
+        sorted_groups = groups[order]
+        starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+        rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+        keep = np.zeros(len(order), dtype=bool)
+        keep[order[rank < k]] = True
+        return keep
+    
+    def _prune(self):
+        user_idx, item_idx, ratings, confidence = self._concatenate()
+        keep = self._keep_mask(user_idx, item_idx, confidence)
+        self._parts = [(user_idx[keep], item_idx[keep], ratings[keep], confidence[keep])]
+        self._kept = self._buffered = int(keep.sum())
+    
+    def result(self):
+        """
+        Returns:
+        - (user_idx, item_idx, rating, confidence) các cặp được chọn; khi có top_k thì sắp theo (user, item)
+        """
+        if self.top_k is None:
+            return self._concatenate()
+        self._prune()
+        user_idx, item_idx, ratings, confidence = self._concatenate()
+        order = np.lexsort((item_idx, user_idx))
+        return user_idx[order], item_idx[order], ratings[order], confidence[order]
+
+def _predict_shared(arrays, params, user_idx, item_idx):
+    """
+    Dự đoán của hai mô hình từ các mảng trong shared memory, cùng công thức với
+    ContentBasedRecommender.predict_batch và MatrixFactorizationRecommender.predict_batch (utils.mf_estimate).
+    """
+    u = arrays['content_users'][user_idx]
+    i = arrays['content_items'][item_idx]
+    known = (u >= 0) & (i >= 0)
+    r_cbf = np.full(len(user_idx), np.nan)
+    r_cbf[known] = np.einsum('ij,ij->i', arrays['user_matrix'][u[known]], arrays['item_matrix'][i[known]]) * 5
+    
+    r_mf = mf_estimate(arrays['mf_users'][user_idx], arrays['mf_items'][item_idx],
+                       arrays['pu'], arrays['qi'], arrays['bu'], arrays['bi'],
+                       params['global_mean'], params['biased'], params['rating_scale'])
+    return r_cbf, r_mf
+
+def _score_shard(spec, params, user_start, user_end):
+    """
+    Chạy trong process worker: duyệt phần U của các user_idx trong [user_start, user_end)
+    và trả về kết quả của PseudoLabelSelector trên shard cùng số cặp vượt ngưỡng.
+    """
+    arrays = SharedArrays.attach(spec)
+    U = UnlabeledSet.from_chunks(params['n_users'], params['n_items'],
+                                 [arrays[f'decided_{k}'] for k in range(params['n_chunks'])])
+    selector = PseudoLabelSelector(params['confidence_threshold'], params['top_k'], params['select_by'])
+    for user_idx, item_idx in U.iter_blocks(params['batch_size'], arrays.get('candidates'), (user_start, user_end)):
+        selector.add_scores(user_idx, item_idx, *_predict_shared(arrays, params, user_idx, item_idx))
+    return selector.result(), selector.n_passed, selector.n_scored
 
 class CoTrainingRecommender:
-    def __init__(self, content_recommender, mf_recommender, ratings_df, batch_size=1000):
+    def __init__(self, content_recommender, mf_recommender, ratings_df, batch_size=1000, candidate_k=None,
+                 n_workers=1):
         """
         Khởi tạo hệ thống gợi ý kết hợp (Co-Training).
         
@@ -19,11 +312,19 @@ class CoTrainingRecommender:
         - mf_recommender: Đối tượng của MatrixFactorizationRecommender
         - ratings_df: DataFrame chứa dữ liệu ['userID', 'itemID', 'rating', 'timestamp']
         - batch_size: Kích thước batch trong quá trình huấn luyện
+        - candidate_k: Nếu đặt, chỉ xét k items gần nhất về nội dung của mỗi user (qua ann_index của
+          content_recommender nếu có) thay vì toàn bộ items; khi co_training cập nhật mô hình, tập ứng viên
+          được tính lại sau mỗi lần cập nhật hồ sơ
+        - n_workers: số process chấm điểm U song song; > 1 thì U được chia theo các dải user liên tiếp
+          và các ma trận của hai mô hình được đặt trong shared memory
         """
         self.content_recommender = content_recommender
         self.mf_recommender = mf_recommender
         self.ratings_df = ratings_df
         self.batch_size = batch_size
+        self.candidate_k = candidate_k
+        self.n_workers = n_workers
+        self.history = []
         self.L, self.U = self._create_labeled_unlabeled_sets()
     
     def _create_labeled_unlabeled_sets(self):
@@ -31,52 +332,254 @@ class CoTrainingRecommender:
         Tạo tập dữ liệu có nhãn (L) và không có nhãn (U).
         """
         L = self.ratings_df.copy()
-        all_user_item_pairs = set(zip(self.ratings_df['userID'], self.ratings_df['itemID']))
-        all_users = self.ratings_df['userID'].unique()
-        all_items = self.ratings_df['itemID'].unique()
-        
-        U = pd.DataFrame([(u, i) for u in all_users for i in all_items if (u, i) not in all_user_item_pairs],
-                         columns=['userID', 'itemID'])
+        U = UnlabeledSet(self.ratings_df['userID'], self.ratings_df['itemID'])
         return L, U
     
-    def co_training(self, max_iter=10, confidence_threshold=0.8):
+    def _content_candidates(self):
+        """
+        Ma trận (n_users, candidate_k) chỉ số items trong U gần nhất với hồ sơ nội dung của mỗi user.
+        """
+        positions, _ = self.content_recommender.nearest_items(self.U.users, self.candidate_k)
+        # Đổi chỉ số trong content_recommender.item_ids sang chỉ số item của U; phần tử cuối (-1) giữ ô trống
+        to_unlabeled = np.append(pd.Index(self.U.items).get_indexer(self.content_recommender.item_ids), -1)
+        return to_unlabeled[positions]
+    
+    def _score_unlabeled(self, selector, candidates=None):
+        """
+        Duyệt U trong process hiện tại, đưa từng khối dự đoán vào selector.
+        """
+        for user_idx, item_idx in self.U.iter_blocks(self.batch_size, candidates):
+            user_ids = self.U.users[user_idx]
+            item_ids = self.U.items[item_idx]
+            
+            r_cbf = self.content_recommender.predict_batch(user_ids, item_ids)
+            r_mf = self.mf_recommender.predict_batch(user_ids, item_ids)
+            selector.add_scores(user_idx, item_idx, r_cbf, r_mf)
+    
+    def _shared_model_arrays(self, candidates=None):
+        """
+        Các mảng worker cần để chấm điểm: ma trận của hai mô hình, ánh xạ chỉ số của U sang chỉ số
+        của từng mô hình (-1 nếu chưa biết), các mảng khóa đã quyết định và ứng viên (nếu có).
+        """
+        content, mf = self.content_recommender, self.mf_recommender
+        arrays = {
+            'user_matrix': content.user_matrix,
+            'item_matrix': content.item_matrix,
+            'content_users': pd.Index(content.user_ids).get_indexer(self.U.users),
+            'content_items': pd.Index(content.item_ids).get_indexer(self.U.items),
+            'pu': mf.pu,
+            'qi': mf.qi,
+            'bu': mf.bu,
+            'bi': mf.bi,
+            'mf_users': pd.Index(mf.user_ids).get_indexer(self.U.users),
+            'mf_items': pd.Index(mf.item_ids).get_indexer(self.U.items),
+        }
+        for k, chunk in enumerate(self.U._decided):
+            arrays[f'decided_{k}'] = chunk
+        if candidates is not None:
+            arrays['candidates'] = candidates
+        return arrays
+    
+    def _score_unlabeled_parallel(self, executor, selector, candidates=None, shards_per_worker=4):
+        """
+        Chia U thành các dải user liên tiếp và chấm điểm chúng trên các process worker.
+        
+        Các mô hình được chép vào shared memory một lần mỗi vòng (chúng thay đổi sau mỗi lần cập nhật).
+        Mỗi shard tự chọn với cùng tiêu chí của selector, rồi kết quả được đưa vào selector theo thứ tự
+        dải nên giống hệt khi chạy tuần tự.
+        """
+        shared = SharedArrays(self._shared_model_arrays(candidates))
+        params = {
+            'n_users': self.U.n_users,
+            'n_items': self.U.n_items,
+            'n_chunks': len(self.U._decided),
+            'batch_size': self.batch_size,
+            'confidence_threshold': selector.confidence_threshold,
+            'top_k': selector.top_k,
+            'select_by': selector.select_by,
+            'global_mean': self.mf_recommender.global_mean,
+            'biased': self.mf_recommender.biased,
+            'rating_scale': self.mf_recommender.rating_scale,
+        }
+        bounds = np.unique(np.linspace(0, self.U.n_users, self.n_workers * shards_per_worker + 1).astype(np.int64))
+        try:
+            futures = [executor.submit(_score_shard, shared.spec, params, int(start), int(end))
+                       for start, end in zip(bounds[:-1], bounds[1:])]
+            for future in futures:
+                selected, n_passed, n_scored = future.result()
+                selector.add(*selected, n_passed=n_passed, n_scored=n_scored)
+        finally:
+            shared.close()
+    
+    def _save_checkpoint(self, checkpoint_dir, round_number, new_users, new_items, new_ratings, save_models=True):
+        """
+        Ghi snapshot của một vòng đã hoàn tất:
+        - round_XXX.npz: nhãn giả mới của vòng (chỉ số trong U và rating) - vừa là phần thêm vào L
+          vừa là phần bị loại khỏi U
+        - models_XXX.npz: trạng thái hai mô hình sau vòng (get_state), snapshot cũ bị xóa
+        - checkpoint.json: vòng cuối cùng đã hoàn tất và history (_write_checkpoint_meta); ghi sau cùng
+          nên luôn trỏ tới một snapshot đầy đủ kể cả khi bị ngắt giữa chừng
+        """
+        checkpoint_dir = Path(checkpoint_dir)
+        save_npz(checkpoint_dir / f'round_{round_number:03d}.npz',
+                 {'user_idx': new_users.astype(np.int32), 'item_idx': new_items.astype(np.int32), 'rating': new_ratings})
+        if save_models:
+            arrays = {f'mf_{key}': value for key, value in self.mf_recommender.get_state().items()}
+            arrays.update({f'content_{key}': value for key, value in self.content_recommender.get_state().items()})
+            save_npz(checkpoint_dir / f'models_{round_number:03d}.npz', arrays)
+        
+        self._write_checkpoint_meta(checkpoint_dir, round_number)
+        for old in checkpoint_dir.glob('models_*.npz'):
+            if old.name != f'models_{round_number:03d}.npz':
+                old.unlink()
+    
+    def _write_checkpoint_meta(self, checkpoint_dir, round_number, stopped=False):
+        """
+        Ghi checkpoint.json (qua file tạm + os.replace). stopped=True đánh dấu vòng sau round_number
+        không tìm được mẫu mới, để lần tiếp tục không chấm điểm lại vòng đó.
+        """
+        checkpoint_dir = Path(checkpoint_dir)
+        meta = {'round': round_number, 'n_users': self.U.n_users, 'n_items': self.U.n_items,
+                'history': self.history, 'stopped': stopped}
+        tmp_path = checkpoint_dir / 'checkpoint.tmp.json'
+        tmp_path.write_text(json.dumps(meta))
+        os.replace(tmp_path, checkpoint_dir / 'checkpoint.json')
+    
+    def _load_checkpoint(self, checkpoint_dir, mark_seen=False):
+        """
+        Khôi phục U, hai mô hình và history từ checkpoint_dir lên một CoTrainingRecommender mới
+        (dựng từ cùng ratings_df và hai mô hình vừa huấn luyện). mark_seen như trong co_training.
+        
+        Returns:
+        - (số vòng đã hoàn tất, list DataFrame nhãn giả của các vòng đó, lần chạy trước đã dừng vì hết mẫu mới hay chưa)
+        """
+        checkpoint_dir = Path(checkpoint_dir)
+        try:
+            meta = json.loads((checkpoint_dir / 'checkpoint.json').read_text())
+        except FileNotFoundError:
+            print("Không tìm thấy checkpoint, bắt đầu từ vòng 1.")
+            return 0, [], False
+        if (meta['n_users'], meta['n_items']) != (self.U.n_users, self.U.n_items):
+            raise ValueError(f"Checkpoint in {checkpoint_dir} was created from different ratings")
+        
+        pseudo_labels = []
+        for round_number in range(1, meta['round'] + 1):
+            with np.load(checkpoint_dir / f'round_{round_number:03d}.npz') as data:
+                user_idx, item_idx, ratings = data['user_idx'], data['item_idx'], data['rating']
+            self.U.remove(user_idx, item_idx)
+            pseudo_labels.append(pd.DataFrame({
+                'userID': self.U.users[user_idx],
+                'itemID': self.U.items[item_idx],
+                'rating': ratings
+            }))
+        
+        models_path = checkpoint_dir / f'models_{meta["round"]:03d}.npz'
+        if models_path.exists():
+            labels = pd.concat(pseudo_labels, ignore_index=True)
+            extra_ratings = (labels['userID'], labels['itemID'], labels['rating'])
+            with np.load(models_path) as data:
+                states = {prefix: {key[len(prefix):]: data[key] for key in data.files if key.startswith(prefix)}
+                          for prefix in ('mf_', 'content_')}
+            self.mf_recommender.set_state(states['mf_'], extra_ratings, mark_seen=mark_seen)
+            self.content_recommender.set_state(states['content_'], extra_ratings if mark_seen else None)
+        
+        self.history = meta['history']
+        if meta.get('stopped'):
+            print(f"Checkpoint đã dừng sau vòng {meta['round']}, không có mẫu mới.")
+        else:
+            print(f"Tiếp tục từ checkpoint sau vòng {meta['round']}.")
+        return meta['round'], pseudo_labels, meta.get('stopped', False)
+    
+    def co_training(self, max_iter=10, confidence_threshold=0.8, update_models=True, mf_epochs=3, replay_ratio=1.0,
+                    top_k=None, select_by='user', checkpoint_dir=None, resume=False, mark_seen=False,
+                    random_state=None):
         """
         Thực hiện thuật toán Co-Training với Mini-Batch.
         
         Parameters:
         - max_iter: Số vòng lặp tối đa.
         - confidence_threshold: Ngưỡng tin cậy để thêm dữ liệu vào tập có nhãn.
+        - update_models: Sau mỗi vòng, cập nhật hai mô hình bằng nhãn giả mới (MF warm-start bằng partial_fit,
+          hồ sơ nội dung bằng update_user_profiles) thay vì giữ nguyên mô hình ban đầu.
+        - mf_epochs, replay_ratio: Tham số partial_fit của mf_recommender.
+        - mark_seen: Đánh dấu nhãn giả là đã thấy trong hai mô hình. Mặc định False: nhãn giả chỉ cập nhật
+          factors / hồ sơ, nên recommend() vẫn gợi ý được các cặp hai mô hình cùng đồng ý (như khi L tách khỏi ratings_df).
+        - random_state: Seed cho partial_fit (vòng thứ n dùng random_state + n), để lần chạy có cập nhật mô hình
+          lặp lại được, kể cả khi tiếp tục từ checkpoint.
+        - top_k, select_by: Giới hạn số nhãn giả mỗi vòng - chỉ giữ top_k cặp tin cậy nhất mỗi user
+          ('user'), mỗi item ('item') hoặc trong cả vòng ('global'); None giữ mọi cặp vượt ngưỡng.
+        
+        - checkpoint_dir: Nếu đặt, ghi snapshot sau mỗi vòng (nhãn giả mới, trạng thái hai mô hình).
+        - resume: Tiếp tục từ vòng cuối cùng đã hoàn tất trong checkpoint_dir thay vì chạy lại các vòng trước;
+          max_iter vẫn là tổng số vòng.
+        
+        Số cặp vượt ngưỡng và số cặp được thêm của mỗi vòng được lưu trong self.history.
         """
-        for iteration in range(max_iter):
-            new_labels = []
-            
-            for batch_start in range(0, len(self.U), self.batch_size):
-                batch = self.U.iloc[batch_start:batch_start + self.batch_size]
-                
-                for _, row in batch.iterrows():
-                    user_id, item_id = row['userID'], row['itemID']
+        start_round, pseudo_labels, stopped = 0, [], False
+        if resume:
+            if checkpoint_dir is None:
+                raise ValueError("resume=True requires checkpoint_dir")
+            start_round, pseudo_labels, stopped = self._load_checkpoint(checkpoint_dir, mark_seen)
+        candidates = self._content_candidates() if self.candidate_k else None
+        executor = ProcessPoolExecutor(max_workers=self.n_workers) if self.n_workers > 1 else None
+        
+        try:
+            for iteration in range(start_round, start_round if stopped else max_iter):
+                with metrics.timer('co_training.round'):
+                    selector = PseudoLabelSelector(confidence_threshold, top_k, select_by)
+                    start = time.perf_counter()
+                    with metrics.timer('co_training.score'):
+                        if executor is None:
+                            self._score_unlabeled(selector, candidates)
+                        else:
+                            self._score_unlabeled_parallel(executor, selector, candidates)
+                        new_users, new_items, new_ratings, _ = selector.result()
+                    score_seconds = time.perf_counter() - start
+                    self.history.append({'round': iteration + 1, 'scored': selector.n_scored,
+                                         'passed': selector.n_passed, 'added': len(new_users),
+                                         'score_seconds': score_seconds})
+                    metrics.record('co_training.pairs_per_second',
+                                   selector.n_scored / score_seconds if score_seconds else None)
+                    metrics.record('co_training.passed', selector.n_passed)
+                    metrics.record('co_training.added', len(new_users))
                     
-                    r_cbf = self.content_recommender.predict(user_id, item_id)
-                    r_mf = self.mf_recommender.predict(user_id, item_id)
+                    if not len(new_users):
+                        print(f"Dừng lại ở vòng {iteration}, không có mẫu mới.")
+                        if checkpoint_dir is not None:
+                            self._write_checkpoint_meta(checkpoint_dir, iteration, stopped=True)
+                        break
                     
-                    if np.isnan(r_cbf) or np.isnan(r_mf):
-                        continue
+                    self.U.remove(new_users, new_items)
+                    new_df = pd.DataFrame({
+                        'userID': self.U.users[new_users],
+                        'itemID': self.U.items[new_items],
+                        'rating': new_ratings
+                    })
+                    pseudo_labels.append(new_df)
                     
-                    confidence = 1 - abs(r_cbf - r_mf) / 5  # Chuẩn hóa tin cậy về khoảng [0,1]
+                    if update_models:
+                        self.mf_recommender.partial_fit(new_df['userID'], new_df['itemID'], new_df['rating'],
+                                                        n_epochs=mf_epochs, replay_ratio=replay_ratio,
+                                                        random_state=None if random_state is None
+                                                        else random_state + iteration,
+                                                        mark_seen=mark_seen)
+                        self.content_recommender.update_user_profiles(new_df['userID'], new_df['itemID'],
+                                                                      new_df['rating'], mark_seen=mark_seen)
+                        if self.candidate_k:
+                            # Hồ sơ đã đổi nên k items gần nhất cũng đổi
+                            candidates = self._content_candidates()
+                    if checkpoint_dir is not None:
+                        self._save_checkpoint(checkpoint_dir, iteration + 1, new_users, new_items, new_ratings,
+                                              save_models=update_models)
                     
-                    if confidence > confidence_threshold:
-                        new_labels.append((user_id, item_id, (r_cbf + r_mf) / 2))
-            
-            if not new_labels:
-                print(f"Dừng lại ở vòng {iteration}, không có mẫu mới.")
-                break
-            
-            new_df = pd.DataFrame(new_labels, columns=['userID', 'itemID', 'rating'])
-            self.L = pd.concat([self.L, new_df], ignore_index=True)
-            self.U = self.U[~self.U.set_index(['userID', 'itemID']).index.isin(new_df.set_index(['userID', 'itemID']).index)]
-            
-            print(f"Vòng {iteration + 1}: Thêm {len(new_labels)} mẫu mới vào tập có nhãn.")
+                    print(f"Vòng {iteration + 1}: Thêm {len(new_users)} mẫu mới vào tập có nhãn "
+                          f"({selector.n_passed} cặp vượt ngưỡng).")
+        finally:
+            if executor is not None:
+                executor.shutdown()
         
+        if pseudo_labels:
+            self.L = pd.concat([self.L, *pseudo_labels], ignore_index=True)
         return self.L
     
 if __name__ == "__main__":
@@ -8,74 +8,295 @@ Created on Sun Feb 23 15:12:05 2025
 
 import numpy as np
 import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy.sparse import csr_matrix, vstack
+from embedding_store import EmbeddingStore
+from utils import mask_seen, top_n_indices
+import metrics
 
 class ContentBasedRecommender:
-    def __init__(self, item_embeddings, ratings_df):
+    def __init__(self, item_embeddings, ratings_df, ann_index=None):
         """
         Khởi tạo hệ thống gợi ý dựa trên nội dung.
         
         Parameters:
-        - item_embeddings: dict {item_id: embedding_vector}
+        - item_embeddings: dict {item_id: embedding_vector} hoặc EmbeddingStore
         - ratings_df: DataFrame chứa các cột ['userID', 'itemID', 'rating', 'timestamp']
+        - ann_index: IVFIndex (tùy chọn) xây trên cùng embeddings để truy xuất ứng viên gần đúng;
+          None thì quét toàn bộ items
+        
+        Embeddings và hồ sơ người dùng được lưu dưới dạng ma trận float32 liên tục, đã chuẩn hóa L2,
+        đánh chỉ số nguyên theo item_ids / user_ids, để cosine chỉ còn là một phép nhân ma trận.
         """
         self.item_embeddings = item_embeddings
         self.ratings_df = ratings_df
-        self.user_profiles = self._build_user_profiles()
+        self.ann_index = ann_index
+        if isinstance(item_embeddings, EmbeddingStore):
+            # Dùng trực tiếp mảng memory-mapped, không tạo dict trung gian
+            self.item_ids = np.asarray(item_embeddings.ids)
+            self._embedding_matrix = item_embeddings.as_float32()
+        else:
+            self.item_ids = np.asarray(list(item_embeddings.keys()))
+            self._embedding_matrix = np.array(list(item_embeddings.values()), dtype=np.float32)
+        self._item_index = pd.Index(self.item_ids)
+        self.item_matrix = self._normalize(self._embedding_matrix)
+        
+        self.user_matrix = self._build_user_profiles()
+        self.seen = self._build_seen_matrix()
     
+    @metrics.timed('content.build_user_profiles')
     def _build_user_profiles(self):
         """
         Xây dựng hồ sơ người dùng dựa trên trung bình có trọng số của embeddings các items mà họ đã đánh giá.
+        
+        Tính bằng một phép nhân ma trận thưa: R (users x items, giá trị là rating) nhân ma trận embedding,
+        chia cho tổng rating mỗi hàng. Tổng có trọng số và tổng trọng số được giữ lại để cập nhật tăng dần.
+        User không có item nào có embedding nhận hồ sơ toàn 0.
         """
-        user_profiles = {}
-        for user_id in self.ratings_df['userID'].unique():
-            user_ratings = self.ratings_df[self.ratings_df['userID'] == user_id]
-            vectors = []
-            weights = []
-            
-            for _, row in user_ratings.iterrows():
-                item_id, rating = row['itemID'], row['rating']
-                if item_id in self.item_embeddings:
-                    vectors.append(self.item_embeddings[item_id])
-                    weights.append(rating)
-            
-            if vectors:
-                user_profiles[user_id] = np.average(vectors, axis=0, weights=weights)
-            else:
-                user_profiles[user_id] = np.zeros_like(next(iter(self.item_embeddings.values())))
-                # user_profiles[user_id] = np.zeros(len(next(iter(self.item_embeddings.values()))))
+        user_idx, self.user_ids = pd.factorize(self.ratings_df['userID'].to_numpy())
+        self._user_index = pd.Index(self.user_ids)
+        item_idx = self._item_index.get_indexer(self.ratings_df['itemID'].to_numpy())
+        known = item_idx >= 0
+        
+        ratings = csr_matrix((self.ratings_df['rating'].to_numpy(dtype=np.float64)[known],
+                              (user_idx[known], item_idx[known])),
+                             shape=(len(self.user_ids), len(self.item_ids)))
+        self._profile_sums = np.asarray(ratings @ self._embedding_matrix, dtype=np.float64)
+        self._profile_weights = np.asarray(ratings.sum(axis=1), dtype=np.float64).ravel()
+        
+        return self._profile_vectors(np.arange(len(self.user_ids)))
+    
+    def _profile_vectors(self, user_idx):
+        """
+        Hồ sơ (đã chuẩn hóa L2, float32) của các users từ tổng có trọng số hiện tại.
+        """
+        weights = self._profile_weights[user_idx, None]
+        profiles = np.divide(self._profile_sums[user_idx], weights,
+                             out=np.zeros_like(self._profile_sums[user_idx]), where=weights != 0)
+        return self._normalize(profiles.astype(np.float32))
+    
+    @metrics.timed('content.update_user_profiles')
+    def update_user_profiles(self, user_ids, item_ids, ratings, mark_seen=True):
+        """
+        Cập nhật tăng dần hồ sơ người dùng với các ratings mới (hoặc nhãn giả từ Co-Training).
+        
+        Chỉ các users bị ảnh hưởng được tính lại; users mới được thêm vào cuối. ratings_df không bị sửa.
+        
+        Parameters:
+        - user_ids, item_ids, ratings: mảng cùng độ dài mô tả các ratings mới
+        - mark_seen: đánh dấu các cặp mới là đã thấy (không gợi ý lại); False cho nhãn giả, vốn chỉ
+          dùng để cập nhật hồ sơ
+        """
+        user_ids = np.asarray(user_ids)
+        user_idx = self._user_index.get_indexer(user_ids)
+        
+        unknown = user_idx < 0
+        if unknown.any():
+            new_users = pd.unique(user_ids[unknown])
+            n_new = len(new_users)
+            dim = self._profile_sums.shape[1]
+            self.user_ids = np.concatenate([self.user_ids, new_users])
+            self._user_index = pd.Index(self.user_ids)
+            self._profile_sums = np.vstack([self._profile_sums, np.zeros((n_new, dim))])
+            self._profile_weights = np.concatenate([self._profile_weights, np.zeros(n_new)])
+            self.user_matrix = np.vstack([self.user_matrix, np.zeros((n_new, dim), dtype=np.float32)])
+            self.seen = vstack([self.seen, csr_matrix((n_new, len(self.item_ids)), dtype=np.bool_)], format='csr')
+            user_idx = self._user_index.get_indexer(user_ids)
+        
+        item_idx = self._item_index.get_indexer(np.asarray(item_ids))
+        known = item_idx >= 0
+        user_idx, item_idx = user_idx[known], item_idx[known]
+        ratings = np.asarray(ratings, dtype=np.float64)[known]
+        
+        np.add.at(self._profile_sums, user_idx, ratings[:, None] * self._embedding_matrix[item_idx])
+        np.add.at(self._profile_weights, user_idx, ratings)
+        affected = np.unique(user_idx)
+        self.user_matrix[affected] = self._profile_vectors(affected)
+        
+        if mark_seen:
+            self._mark_seen(user_idx, item_idx)
+    
+    def _mark_seen(self, user_idx, item_idx):
+        new_seen = csr_matrix((np.ones(len(user_idx), dtype=np.bool_), (user_idx, item_idx)), shape=self.seen.shape)
+        self.seen = (self.seen + new_seen).astype(np.bool_)
+    
+    def get_state(self):
+        """
+        Trạng thái hồ sơ người dùng (user_ids, tổng có trọng số, tổng trọng số) dưới dạng dict mảng, dùng cho checkpoint.
+        """
+        return {'user_ids': self.user_ids, 'profile_sums': self._profile_sums, 'profile_weights': self._profile_weights}
+    
+    def set_state(self, state, extra_ratings=None):
+        """
+        Khôi phục hồ sơ người dùng từ get_state trên một recommender dựng từ cùng ratings_df và embeddings.
+        
+        Parameters:
+        - state: dict từ get_state
+        - extra_ratings: (tùy chọn) (user_ids, item_ids, ratings) đã cộng vào hồ sơ với mark_seen=True
+          sau ratings_df, chỉ dùng để đánh dấu lại các cặp đã thấy
+        """
+        if state['profile_sums'].shape[1] != self._embedding_matrix.shape[1]:
+            raise ValueError("Checkpoint profiles do not match the embedding dimension")
+        self.user_ids = np.asarray(state['user_ids'])
+        self._user_index = pd.Index(self.user_ids)
+        self._profile_sums = np.array(state['profile_sums'], dtype=np.float64)
+        self._profile_weights = np.array(state['profile_weights'], dtype=np.float64)
+        self.user_matrix = self._profile_vectors(np.arange(len(self.user_ids)))
+        self.seen = self._build_seen_matrix()
+        if extra_ratings is not None:
+            user_ids, item_ids, _ = extra_ratings
+            user_idx = self._user_index.get_indexer(np.asarray(user_ids))
+            item_idx = self._item_index.get_indexer(np.asarray(item_ids))
+            known = (user_idx >= 0) & (item_idx >= 0)
+            self._mark_seen(user_idx[known], item_idx[known])
+        return self
+    
+    def _build_seen_matrix(self):
+        """
+        Ma trận CSR (users x items) đánh dấu các items mỗi user đã đánh giá.
+        """
+        user_idx = self._user_index.get_indexer(self.ratings_df['userID'].to_numpy())
+        item_idx = self._item_index.get_indexer(self.ratings_df['itemID'].to_numpy())
+        known = (user_idx >= 0) & (item_idx >= 0)
+        seen = csr_matrix((np.ones(known.sum(), dtype=np.bool_), (user_idx[known], item_idx[known])),
+                          shape=(len(self.user_ids), len(self.item_ids)))
+        seen.sum_duplicates()
+        return seen
+    
+    @staticmethod
+    def _normalize(matrix):
+        """
+        Chuẩn hóa L2 theo hàng, giữ nguyên các hàng toàn 0 (giống sklearn).
+        """
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return np.ascontiguousarray(matrix / norms)
+    
+    def score_users(self, user_idx):
+        """
+        Tính điểm của một nhóm users (theo chỉ số nguyên) với toàn bộ items bằng một phép GEMM.
+        
+        Returns:
+        - np.ndarray (len(user_idx), n_items) đã scale về thang điểm 5
+        """
+        return (self.user_matrix[user_idx] @ self.item_matrix.T) * 5
+    
+    def predict_batch(self, user_ids, item_ids):
+        """
+        Dự đoán cho nhiều cặp (user, item) cùng lúc.
+        
+        Parameters:
+        - user_ids, item_ids: mảng cùng độ dài chứa các cặp cần dự đoán
         
-        return user_profiles
+        Returns:
+        - np.ndarray điểm dự đoán, NaN tại các cặp thiếu dữ liệu
+        """
+        user_idx = self._user_index.get_indexer(np.asarray(user_ids))
+        item_idx = self._item_index.get_indexer(np.asarray(item_ids))
+        known = (user_idx >= 0) & (item_idx >= 0)
+        
+        scores = np.full(len(user_idx), np.nan)
+        similarity = np.einsum('ij,ij->i', self.user_matrix[user_idx[known]], self.item_matrix[item_idx[known]])
+        scores[known] = similarity * 5  # Scale về thang điểm 5
+        return scores
     
     def predict(self, user_id, item_id):
         """
         Dự đoán mức độ yêu thích của user đối với item dựa trên độ tương đồng cosine.
         """
-        if user_id not in self.user_profiles or item_id not in self.item_embeddings:
-            return np.nan  # Không thể dự đoán nếu thiếu dữ liệu
+        return self.predict_batch([user_id], [item_id])[0]
+    
+    def nearest_items(self, user_ids, k, batch_size=1024, exact=False):
+        """
+        Tìm k items gần nhất với hồ sơ của mỗi user (kể cả items đã đánh giá).
+        exact=True buộc ann_index quét toàn bộ (brute-force) thay vì chỉ n_probe cụm.
         
-        user_vector = self.user_profiles[user_id].reshape(1, -1)
-        item_vector = self.item_embeddings[item_id].reshape(1, -1)
-        similarity = cosine_similarity(user_vector, item_vector)[0, 0]
+        Không có ann_index thì quét toàn bộ items theo từng batch batch_size users, để bộ nhớ tạm
+        chỉ là (batch_size, n_items) thay vì (len(user_ids), n_items).
         
-        return similarity * 5  # Scale về thang điểm 5
+        Returns:
+        - positions: (len(user_ids), k) chỉ số trong item_ids, -1 nếu thiếu hoặc user chưa biết
+        - scores: (len(user_ids), k) điểm đã scale về thang 5, -inf nếu thiếu
+        """
+        user_idx = self._user_index.get_indexer(np.asarray(user_ids))
+        positions = np.full((len(user_idx), k), -1, dtype=np.int64)
+        scores = np.full((len(user_idx), k), -np.inf, dtype=np.float32)
+        known = np.flatnonzero(user_idx >= 0)
+        if not len(known):
+            return positions, scores
+        
+        if self.ann_index is not None:
+            found, similarity = self.ann_index.search(self.user_matrix[user_idx[known]], k, exact=exact)
+            valid = found >= 0
+            found[valid] = self._item_index.get_indexer(self.ann_index.ids[found[valid]])
+            positions[known] = found
+            scores[known] = similarity * 5
+            return positions, scores
+        
+        for start in range(0, len(known), batch_size):
+            rows = known[start:start + batch_size]
+            batch_scores = self.score_users(user_idx[rows])
+            found = np.full((len(rows), k), -1, dtype=np.int64)
+            for row, top in enumerate(top_n_indices(batch_scores, k)):
+                found[row, :len(top)] = top
+            batch_scores = np.take_along_axis(batch_scores, np.maximum(found, 0), axis=1)
+            batch_scores[found < 0] = -np.inf
+            positions[rows] = found
+            scores[rows] = batch_scores
+        return positions, scores
     
-    def recommend(self, user_id, top_n=5):
+    @metrics.timed('content.recommend_batch')
+    def recommend_batch(self, user_ids, top_n=5, batch_size=1024):
         """
-        Gợi ý top N items cho một user dựa trên nội dung.
+        Gợi ý top N items cho nhiều users, mỗi batch users chỉ cần một phép nhân ma trận.
+        
+        Khi có ann_index, ứng viên được lấy từ chỉ mục (lấy dư thêm số items đã đánh giá) thay vì quét toàn bộ;
+        user nào nhận ít hơn top_n items chưa đánh giá trong khi vẫn còn items khác thì được tìm lại bằng brute-force.
+        
+        Returns:
+        - list (cùng thứ tự user_ids) các list [(item_id, score)]; user chưa biết trả về []
         """
-        if user_id not in self.user_profiles:
-            return []
+        user_idx = self._user_index.get_indexer(np.asarray(user_ids))
+        results = [[] for _ in range(len(user_idx))]
+        known = np.flatnonzero(user_idx >= 0)
         
-        scores = []
-        for item_id in self.item_embeddings:
-            if item_id not in self.ratings_df[self.ratings_df['userID'] == user_id]['itemID'].values:
-                predicted_rating = self.predict(user_id, item_id)
-                if not np.isnan(predicted_rating):
-                    scores.append((item_id, predicted_rating))
+        for start in range(0, len(known), batch_size):
+            rows = known[start:start + batch_size]
+            seen = self.seen[user_idx[rows]]
+            
+            if self.ann_index is not None:
+                k = top_n + int(np.diff(seen.indptr).max(initial=0))
+                batch_users = self.user_ids[user_idx[rows]]
+                positions, scores = self.nearest_items(batch_users, k)
+                short = []
+                for j, row in enumerate(rows):
+                    results[row] = self._unseen_top(positions[j], scores[j], seen, j, top_n)
+                    n_unseen = len(self.item_ids) - (seen.indptr[j + 1] - seen.indptr[j])
+                    if len(results[row]) < min(top_n, n_unseen):
+                        short.append(j)
+                if short:
+                    # Các cụm được dò không đủ items chưa đánh giá: tìm lại chính xác cho các users này
+                    positions, scores = self.nearest_items(batch_users[short], k, exact=True)
+                    for exact_row, j in enumerate(short):
+                        results[rows[j]] = self._unseen_top(positions[exact_row], scores[exact_row], seen, j, top_n)
+                continue
+            
+            scores = mask_seen(self.score_users(user_idx[rows]), seen)
+            for row, row_scores, top in zip(rows, scores, top_n_indices(scores, top_n)):
+                results[row] = [(self.item_ids[i], row_scores[i]) for i in top]
         
-        scores.sort(key=lambda x: x[1], reverse=True)
-        return scores[:top_n]
+        return results
+    
+    def _unseen_top(self, positions, scores, seen, j, top_n):
+        """Top N [(item_id, score)] trong các ứng viên (đã sắp giảm dần) của hàng j, bỏ items đã đánh giá"""
+        seen_items = seen.indices[seen.indptr[j]:seen.indptr[j + 1]]
+        keep = (positions >= 0) & ~np.isin(positions, seen_items)
+        return [(self.item_ids[i], score) for i, score in zip(positions[keep][:top_n], scores[keep][:top_n])]
+    
+    def recommend(self, user_id, top_n=5):
+        """
+        Gợi ý top N items cho một user dựa trên nội dung.
+        """
+        return self.recommend_batch([user_id], top_n)[0]
 
 if __name__ == "__main__":
     pass
\ No newline at end of file
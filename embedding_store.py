@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped item embedding store.
+
+Layout of a store directory (compatible with ItemEmbeddingGenerator.save_embeddings):
+    items.npy       sorted item ids
+    embeddings.npy  one row per item, float32 / float16 / int8
+    scales.npy      per-row float32 scales (int8 only)
+
+Arrays are opened with mmap_mode='r', so several processes share one page-cached copy
+and opening a store does not depend on the number of items.
+"""
+
+import numpy as np
+from pathlib import Path
+
+STORAGE_DTYPES = ('float32', 'float16', 'int8')
+
+def quantize(matrix, dtype='float32'):
+    """
+    Convert a float matrix to the storage dtype.
+
+    Returns (stored_matrix, scales); scales is None unless dtype is int8, where each row is
+    scaled symmetrically by max(|x|) / 127.
+    """
+    if dtype not in STORAGE_DTYPES:
+        raise ValueError(f"dtype must be one of {STORAGE_DTYPES}, got {dtype}")
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if dtype != 'int8':
+        return matrix.astype(dtype), None
+
+    scales = np.abs(matrix).max(axis=1) / 127
+    scales[scales == 0] = 1.0
+    return np.round(matrix / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+def dequantize(matrix, scales=None):
+    """Inverse of quantize, always returns float32"""
+    if scales is None:
+        return np.asarray(matrix, dtype=np.float32)
+    return matrix.astype(np.float32) * scales[:, None]
+
+class EmbeddingStore:
+    def __init__(self, load_dir='data_save/embeddings', mmap_mode='r'):
+        """
+        Open a store.
+
+        Args:
+            load_dir: Directory containing items.npy / embeddings.npy (/ scales.npy)
+            mmap_mode: Passed to np.load; None loads everything into memory
+        """
+        self.load_dir = load_dir
+        self.ids = np.load(f'{load_dir}/items.npy', mmap_mode=mmap_mode)
+        self.matrix = np.load(f'{load_dir}/embeddings.npy', mmap_mode=mmap_mode)
+        scales_path = Path(f'{load_dir}/scales.npy')
+        self.scales = np.load(scales_path, mmap_mode=mmap_mode) if scales_path.exists() else None
+        if len(self.ids) > 1 and np.any(self.ids[1:] < self.ids[:-1]):
+            raise ValueError(f"Item ids in {load_dir}/items.npy are not sorted")
+
+    @staticmethod
+    def save(ids, matrix, save_dir='data_save/embeddings', dtype='float32'):
+        """
+        Write a store, sorting rows by item id.
+
+        Args:
+            ids: Item ids, one per row of matrix
+            matrix: Embedding matrix (n_items, d)
+            dtype: Storage dtype, one of float32 / float16 / int8
+        """
+        ids = np.asarray(ids)
+        order = np.argsort(ids, kind='stable')
+        stored, scales = quantize(np.asarray(matrix)[order], dtype)
+
+        Path(save_dir).mkdir(parents=True, exist_ok=True)
+        np.save(f'{save_dir}/embeddings.npy', stored)
+        np.save(f'{save_dir}/items.npy', ids[order])
+        scales_path = Path(f'{save_dir}/scales.npy')
+        if scales is not None:
+            np.save(scales_path, scales)
+        elif scales_path.exists():
+            scales_path.unlink()
+
+    @classmethod
+    def from_dict(cls, embeddings, save_dir='data_save/embeddings', dtype='float32'):
+        """Write a {item_id: vector} dict as a store and open it"""
+        items = list(embeddings.keys())
+        cls.save(items, np.stack([embeddings[item] for item in items]), save_dir, dtype)
+        return cls(save_dir)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, item_id):
+        return self.positions([item_id])[0] >= 0
+
+    def __getitem__(self, item_id):
+        """Float32 vector of item_id for every storage dtype; a zero-copy view when stored as float32"""
+        position = self.positions([item_id])[0]
+        if position < 0:
+            raise KeyError(item_id)
+        if self.scales is None and self.matrix.dtype == np.float32:
+            return self.matrix[position]
+        return self.rows([position])[0]
+
+    @property
+    def dim(self):
+        return self.matrix.shape[1]
+
+    def positions(self, item_ids):
+        """Row positions of item_ids via searchsorted, -1 for unknown ids"""
+        item_ids = np.asarray(item_ids)
+        if len(self.ids) == 0:
+            return np.full(len(item_ids), -1, dtype=np.int64)
+        positions = np.searchsorted(self.ids, item_ids)
+        positions[positions == len(self.ids)] = 0
+        return np.where(self.ids[positions] == item_ids, positions, -1)
+
+    def slice(self, start, stop):
+        """Zero-copy view of a contiguous range of rows (raw storage dtype)"""
+        return self.matrix[start:stop]
+
+    def rows(self, positions):
+        """Float32 vectors at the given row positions (a copy, dequantized if needed)"""
+        positions = np.asarray(positions)
+        scales = None if self.scales is None else self.scales[positions]
+        return dequantize(self.matrix[positions], scales)
+
+    def as_float32(self):
+        """The full matrix as float32; zero-copy when stored as float32"""
+        if self.scales is None and self.matrix.dtype == np.float32:
+            return self.matrix
+        return dequantize(self.matrix, self.scales)
@@ -6,19 +6,52 @@ Created on Sun Feb 23 15:13:08 2025
 @author: rcyuh
 """
 
-from sentence_transformers import SentenceTransformer
 import numpy as np
-from typing import Dict, Set
+from typing import Dict, List, Set
+import hashlib
 import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 from pathlib import Path
-from preprocessing import preprocessing_meta_data, preprocessing_matrix
+from preprocessing import preprocessing_meta_data, preprocessing_matrix, preprocessing_stream
+from embedding_store import EmbeddingStore
+import metrics
 
-os.environ["TOKENIZjsonERS_PARALLELISM"] = "false"
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+_worker_model = None
+
+def _load_sentence_transformer(source: str, device: str = 'cpu'):
+    """Load a SentenceTransformer; a local directory is loaded without any hub lookup"""
+    from sentence_transformers import SentenceTransformer
+    if Path(source).is_dir():
+        return SentenceTransformer(source, device=device, local_files_only=True)
+    return SentenceTransformer(source, device=device)
+
+def _init_encode_worker(model_source, device: str, n_threads: int):
+    """Pool initializer: each worker loads its own copy of the model once"""
+    global _worker_model
+    try:
+        import torch
+        torch.set_num_threads(n_threads)
+    except ImportError:
+        pass
+    _worker_model = _load_sentence_transformer(model_source, device) if isinstance(model_source, str) else model_source
+
+def _encode_in_worker(batch: List[str]) -> np.ndarray:
+    return np.asarray(_worker_model.encode(batch, batch_size=len(batch), show_progress_bar=False), dtype=np.float32)
 
 class ItemEmbeddingGenerator:
     def __init__(self, 
                 output_dimension: int = 384,  # MiniLM có 384 chiều
-                include_fields: Set[str] = None):
+                include_fields: Set[str] = None,
+                model_name: str = 'all-MiniLM-L6-v2',
+                cache_dir: str = 'data_save/embeddings/cache',
+                model=None,
+                model_path: str = None,
+                device: str = 'cpu',
+                batch_size: int = 64,
+                n_workers: int = 1):
         """
         Initialize generator with configurable fields
         
@@ -26,10 +59,99 @@ class ItemEmbeddingGenerator:
             output_dimension: Embedding dimension (default 384 for MiniLM)
             include_fields: Set of fields to include in prompt
                           (topic, sequence_type, problem_type, amount, difficulty)
+            model_name: SentenceTransformer model name, part of the cache key (see model_identity)
+            cache_dir: Directory of the prompt-hash embedding cache (None to disable); each
+                       generate_item_embeddings call keeps only the prompts of its items
+            model: Encoder with an encode(texts, **kwargs) method to use instead of loading model_name,
+                   e.g. a stub for offline benchmarks. Its class name is part of the cache key, so
+                   it never shares entries with the real model; pass a distinct model_name when
+                   instances of one class produce different vectors
+            model_path: Local directory of the model (e.g. a copy saved with model.save(path));
+                        loaded with local_files_only so no network access is needed.
+                        Defaults to the ITEM_EMBEDDING_MODEL_PATH environment variable, so offline
+                        hosts can be configured once; with neither set, model_name is resolved
+                        through the Hugging Face hub/cache. The resolved directory and a fingerprint
+                        of its config files are part of the cache key.
+            device: Torch device used when the model is loaded
+            batch_size: Number of prompts per encode call; prompts are sorted by length first
+                        so each batch pads to similar lengths
+            n_workers: Number of CPU processes encoding batches in parallel (1 = in-process)
+
+        The model is loaded on first use, so load_embeddings / load_embedding_store never load it.
         """
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
+        self.model_name = model_name
+        model_path = model_path or os.environ.get('ITEM_EMBEDDING_MODEL_PATH')
+        if model_path is not None and not Path(model_path).is_dir():
+            raise FileNotFoundError(f"Model directory not found: {model_path}")
+        self.model_path = model_path
+        self.device = device
+        self.batch_size = batch_size
+        self.n_workers = n_workers
+        self._model = model
+        self._custom_model = model is not None
+        self.cache_dir = cache_dir
+        self.cache_stats = {'hits': 0, 'misses': 0}
         self.output_dimension = output_dimension
         self.include_fields = include_fields or {'topic', 'amount', 'difficulty', 'sequence_type', 'problem_type'} 
+        self.model_identity = self._model_identity()
+
+    def _model_identity(self) -> str:
+        """
+        Identity of the weights actually used, hashed into every cache key: model_name, plus the
+        class of an injected encoder, or the resolved model_path and a fingerprint of its *.json
+        config files when loading from disk, so vectors of another model are never served from the cache
+        """
+        if self._custom_model:
+            encoder = type(self._model)
+            return f"{self.model_name}@{encoder.__module__}.{encoder.__qualname__}"
+        if self.model_path is None:
+            return self.model_name
+        model_dir = Path(self.model_path).resolve()
+        digest = hashlib.blake2b(digest_size=8)
+        for config in sorted(model_dir.glob('*.json')):
+            digest.update(config.name.encode('utf-8'))
+            digest.update(config.read_bytes())
+        return f"{self.model_name}@{model_dir}#{digest.hexdigest()}"
+
+    @property
+    def model(self):
+        """The encoder, loaded on first access (from model_path when given)"""
+        if self._model is None:
+            self._model = _load_sentence_transformer(self.model_path or self.model_name, self.device)
+        return self._model
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """
+        Encode prompts into a float32 matrix (same row order as texts).
+
+        Prompts are sorted by length (longest first) and cut into batch_size batches, so padding
+        inside a batch is small; with n_workers > 1 the batches are spread over a process pool.
+        """
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+        batches = [[texts[i] for i in order[start:start + self.batch_size]]
+                   for start in range(0, len(order), self.batch_size)]
+
+        if self.n_workers > 1 and len(batches) > 1:
+            # Workers load the model themselves from model_path / model_name; only an injected encoder is
+            # pickled (never a SentenceTransformer loaded lazily by an earlier call)
+            source = self._model if self._custom_model else (self.model_path or self.model_name)
+            n_threads = max(1, (os.cpu_count() or 1) // self.n_workers)
+            with metrics.timer('embedding.encode_pool'):
+                with ProcessPoolExecutor(max_workers=self.n_workers, mp_context=get_context('spawn'),
+                                         initializer=_init_encode_worker,
+                                         initargs=(source, self.device, n_threads)) as executor:
+                    encoded = list(executor.map(_encode_in_worker, batches))
+        else:
+            encoded = []
+            for batch in batches:
+                with metrics.timer('embedding.encode_batch'):
+                    encoded.append(np.asarray(self.model.encode(batch, batch_size=len(batch), show_progress_bar=False),
+                                              dtype=np.float32))
+
+        vectors = np.empty((len(texts), encoded[0].shape[1]) if encoded else (0, self.output_dimension), dtype=np.float32)
+        if encoded:
+            vectors[order] = np.concatenate(encoded)
+        return vectors
 
     def create_embedding_input(self, item_data: Dict) -> str:
         """Tạo prompt đầu vào dựa trên các trường được chọn"""
@@ -73,43 +195,101 @@ class ItemEmbeddingGenerator:
 
         return "\n".join(prompt_parts)
 
+    @metrics.timed('embedding.generate')
     def generate_item_embeddings(self, items: Dict) -> Dict[str, np.ndarray]:
-        """Tạo embedding từ danh sách sản phẩm"""
+        """Tạo embedding từ danh sách sản phẩm, chỉ encode các prompt chưa có trong cache"""
         embeddings = {}
         texts = {item_id: self.create_embedding_input(data) for item_id, data in items.items()}
+        keys = [self._cache_key(text) for text in texts.values()]
+
+        cache = self._load_cache()
+        is_miss = [key not in cache for key in keys]
+        self.cache_stats = {'hits': is_miss.count(False), 'misses': is_miss.count(True)}
+        metrics.count('embedding.cache.hits', self.cache_stats['hits'])
+        metrics.count('embedding.cache.misses', self.cache_stats['misses'])
+        missing = {key: text for key, text, miss in zip(keys, texts.values(), is_miss) if miss}
 
-        # Encode tất cả các văn bản cùng lúc để nhanh hơn
-        encoded_vectors = self.model.encode(list(texts.values()))
+        if missing:
+            # Encode theo batch đã sắp theo độ dài (và song song nếu n_workers > 1)
+            encoded_vectors = self.encode(list(missing.values()))
+            metrics.count('embedding.encoded', len(missing))
+            cache.update({key: np.asarray(vector) for key, vector in zip(missing.keys(), encoded_vectors)})
+        # Chỉ giữ các prompt hiện tại, để entries của prompt đã đổi không tích lũy mãi trong file cache
+        current = set(keys)
+        if missing or len(cache) > len(current):
+            self._save_cache({key: vector for key, vector in cache.items() if key in current})
+        print(f"Embedding cache: {self.cache_stats['hits']} hits, {self.cache_stats['misses']} misses")
 
-        for item_id, vector in zip(texts.keys(), encoded_vectors):
-            embeddings[item_id] = np.array(vector)
+        for item_id, key in zip(texts.keys(), keys):
+            embeddings[item_id] = np.array(cache[key])
 
         return embeddings
+
+    def _cache_key(self, text: str) -> str:
+        """Hash of (model identity, include_fields, prompt text)"""
+        payload = "\x1f".join([self.model_identity, ",".join(sorted(self.include_fields)), text])
+        return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+    def _load_cache(self) -> Dict[str, np.ndarray]:
+        """Load the prompt-hash cache as {key: vector}"""
+        if self.cache_dir is None:
+            return {}
+        try:
+            with np.load(f'{self.cache_dir}/embedding_cache.npz') as data:
+                return dict(zip(data['keys'].tolist(), data['vectors']))
+        except FileNotFoundError:
+            return {}
+
+    def _save_cache(self, cache: Dict[str, np.ndarray]):
+        """Write the cache atomically so an interrupted run never leaves a broken file"""
+        if self.cache_dir is None:
+            return
+        Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+        tmp_path = f'{self.cache_dir}/embedding_cache.tmp.npz'
+        np.savez(tmp_path, keys=np.array(list(cache.keys()), dtype='U32'), vectors=np.stack(list(cache.values())))
+        os.replace(tmp_path, f'{self.cache_dir}/embedding_cache.npz')
     
-    def save_embeddings(self, embeddings, save_dir='data_save/embeddings'):
-        """Save embeddings to disk"""
-        Path(save_dir).mkdir(parents=True, exist_ok=True)
-        items = sorted(embeddings.keys())
-        embedding_array = np.stack([embeddings[item] for item in items])
-        np.save(f'{save_dir}/embeddings.npy', embedding_array)
-        np.save(f'{save_dir}/items.npy', np.array(items))
+    def save_embeddings(self, embeddings, save_dir='data_save/embeddings', dtype='float32'):
+        """Save embeddings to disk (dtype: float32, float16 or int8 with per-vector scales)"""
+        items = list(embeddings.keys())
+        EmbeddingStore.save(items, np.stack([embeddings[item] for item in items]), save_dir, dtype)
         print(f"Saved embeddings to {save_dir}")
         
-    def load_embeddings(self, load_dir='data_save/embeddings'):
-        """Load embeddings and create item mapping"""
+    def generate_embedding_store(self, items: Dict, save_dir='data_save/embeddings', dtype='float16') -> EmbeddingStore:
+        """
+        Generate embeddings and write them as a quantized EmbeddingStore (float16 halves the matrix,
+        int8 with per-vector scales quarters it), returning the memory-mapped store
+        """
+        self.save_embeddings(self.generate_item_embeddings(items), save_dir, dtype)
+        return EmbeddingStore(save_dir)
+
+    def load_embedding_store(self, load_dir='data_save/embeddings'):
+        """Open saved embeddings as a memory-mapped EmbeddingStore"""
         try:
-            embedding_array = np.load(f'{load_dir}/embeddings.npy')
-            items = np.load(f'{load_dir}/items.npy')
-            embeddings = {item: emb for item, emb in zip(items, embedding_array)}
-            item_to_idx = {item: idx for idx, item in enumerate(items)}
-            print(f"Loaded embeddings for {len(embeddings)} items")
+            store = EmbeddingStore(load_dir)
+            print(f"Loaded embeddings for {len(store)} items")
             
-            return embeddings, item_to_idx
+            return store
         
         except FileNotFoundError:
             print("No saved embeddings found")
             
+            return None
+        
+    def load_embeddings(self, load_dir='data_save/embeddings'):
+        """
+        Load embeddings and create item mapping. Dict values are float32 for every storage dtype:
+        views into the memory-mapped store when stored as float32, dequantized rows otherwise
+        """
+        store = self.load_embedding_store(load_dir)
+        if store is None:
             return None, None
+        
+        matrix = store.as_float32()
+        embeddings = {item: emb for item, emb in zip(store.ids.tolist(), matrix)}
+        item_to_idx = {item: idx for idx, item in enumerate(store.ids.tolist())}
+        
+        return embeddings, item_to_idx
     
     def debug_prompt(self, items: Dict, num_samples: int = 3):
         """Hiển thị ví dụ prompt"""
@@ -127,14 +307,14 @@ if __name__ == "__main__":
     file_path = "/home/rcyuh/Desktop/1. Đồ án tốt nghiệp/Co-supervised/assistment_2012_2013.csv"
     nrows=1000
     
-    pre = preprocessing_matrix(file_path=file_path)
-    pre.reverse_correct()
-    pre.filter_matrix()
+    # Đọc file CSV một lần cho cả ma trận và meta data; chỉ đọc khi cache chưa có hoặc file nguồn đã đổi
+    stream = preprocessing_stream(file_path=file_path)
+    
+    pre = preprocessing_matrix.load_or_process(stream=stream)
     matrix_df = pre.df
     unique_values = pre.extract_sequence_id()
     
-    pre_meta = preprocessing_meta_data(file_path=file_path, sequence_id_list=unique_values)
-    items_dict = pre_meta.process()
+    items_dict = preprocessing_meta_data.load_or_process(stream=stream, sequence_id_list=unique_values)
     
     generator = ItemEmbeddingGenerator()
     item_embeddings = generator.generate_item_embeddings(items_dict)
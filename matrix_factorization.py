@@ -8,53 +8,284 @@ Created on Sun Feb 23 15:12:31 2025
 
 import numpy as np
 import pandas as pd
+from scipy.sparse import csr_matrix
 from surprise import SVD, Dataset, Reader
 from preprocessing import preprocessing_meta_data, preprocessing_matrix
+from als import ALS
+from utils import mask_seen, mf_estimate, mf_scores, top_n_indices
+import metrics
 
 class MatrixFactorizationRecommender:
-    def __init__(self, ratings_df, n_factors=50):
+    def __init__(self, ratings_df, n_factors=50, backend='svd', **backend_params):
         """
         Khởi tạo hệ thống gợi ý dựa trên Matrix Factorization (SVD).
         
         Parameters:
         - ratings_df: DataFrame chứa các cột ['userID', 'itemID', 'rating', 'timestamp']
         - n_factors: Số lượng latent factors trong mô hình SVD.
+        - backend: 'svd' (surprise.SVD, đơn luồng) hoặc 'als' (als.ALS, NumPy đa luồng)
+        - backend_params: Tham số bổ sung cho backend (ví dụ n_epochs, reg, alpha, n_jobs của ALS)
         """
         self.ratings_df = ratings_df
         self.n_factors = n_factors
+        self.backend = backend
+        self.backend_params = backend_params
         self.model = self._train_model()
+        self._extract_factors()
     
+    @metrics.timed('mf.fit')
     def _train_model(self):
         """
         Huấn luyện mô hình SVD trên tập dữ liệu đầu vào.
         """
-        reader = Reader(rating_scale=(self.ratings_df['rating'].min(), self.ratings_df['rating'].max()))
+        rating_scale = (self.ratings_df['rating'].min(), self.ratings_df['rating'].max())
+        if self.backend == 'als':
+            model = ALS(n_factors=self.n_factors, **self.backend_params)
+            model.fit(self.ratings_df['userID'], self.ratings_df['itemID'], self.ratings_df['rating'], rating_scale)
+            return model
+        if self.backend != 'svd':
+            raise ValueError(f"Unknown backend: {self.backend}")
+        
+        reader = Reader(rating_scale=rating_scale)
         dataset = Dataset.load_from_df(self.ratings_df[['userID', 'itemID', 'rating']], reader)
         trainset = dataset.build_full_trainset()
         
-        model = SVD(n_factors=self.n_factors)
+        model = SVD(n_factors=self.n_factors, **self.backend_params)
         model.fit(trainset)
         
         return model
     
+    def _extract_factors(self):
+        """
+        Lấy pu, qi, bu, bi, global mean từ mô hình đã huấn luyện, cùng ánh xạ raw id -> inner id
+        và ma trận CSR các items mỗi user đã đánh giá, để dự đoán/gợi ý theo batch.
+        """
+        model = self.model
+        if self.backend == 'als':
+            self.user_ids, self.item_ids = model.user_ids, model.item_ids
+            self.global_mean, self.rating_scale = model.global_mean, model.rating_scale
+        else:
+            trainset = model.trainset
+            # user_ids[inner_id] = raw_id, nên get_indexer trả về trực tiếp inner id (-1 nếu chưa biết)
+            self.user_ids = self._raw_ids_by_inner(trainset._raw2inner_id_users)
+            self.item_ids = self._raw_ids_by_inner(trainset._raw2inner_id_items)
+            self.global_mean, self.rating_scale = trainset.global_mean, trainset.rating_scale
+        self._user_index = pd.Index(self.user_ids)
+        self._item_index = pd.Index(self.item_ids)
+        
+        self.biased = model.biased
+        # Sao chép để partial_fit cập nhật tại chỗ mà không làm hỏng mô hình gốc
+        self.pu = np.array(model.pu, dtype=np.float64)
+        self.qi = np.array(model.qi, dtype=np.float64)
+        self.bu = np.array(model.bu, dtype=np.float64) if model.biased else np.zeros(len(self.user_ids))
+        self.bi = np.array(model.bi, dtype=np.float64) if model.biased else np.zeros(len(self.item_ids))
+        
+        # Tập có nhãn dưới dạng mảng inner id, dùng làm replay cho partial_fit
+        self._train_users = self._user_index.get_indexer(self.ratings_df['userID'].to_numpy())
+        self._train_items = self._item_index.get_indexer(self.ratings_df['itemID'].to_numpy())
+        self._train_ratings = self.ratings_df['rating'].to_numpy(dtype=np.float64)
+        self.seen = csr_matrix((np.ones(len(self._train_users), dtype=np.bool_), (self._train_users, self._train_items)),
+                               shape=(len(self.user_ids), len(self.item_ids)))
+        self.seen.sum_duplicates()
+    
+    @staticmethod
+    def _raw_ids_by_inner(raw2inner):
+        raw_ids = np.asarray(list(raw2inner.keys()))
+        ordered = np.empty_like(raw_ids)
+        ordered[np.fromiter(raw2inner.values(), dtype=np.int64, count=len(raw_ids))] = raw_ids
+        return ordered
+    
+    def predict_batch(self, user_ids, item_ids):
+        """
+        Dự đoán cho nhiều cặp (user, item) cùng lúc, cùng công thức với SVD.estimate của surprise:
+        mu + bu + bi + qi·pu, bỏ các thành phần của user/item chưa biết, rồi cắt về rating_scale.
+        
+        Parameters:
+        - user_ids, item_ids: mảng cùng độ dài chứa các cặp cần dự đoán
+        
+        Returns:
+        - np.ndarray điểm dự đoán
+        """
+        return mf_estimate(self._user_index.get_indexer(np.asarray(user_ids)),
+                           self._item_index.get_indexer(np.asarray(item_ids)), **self._factor_arrays())
+    
+    def _factor_arrays(self):
+        """Tham số mô hình theo tên đối số của utils.mf_estimate / utils.mf_scores"""
+        return {'pu': self.pu, 'qi': self.qi, 'bu': self.bu, 'bi': self.bi, 'global_mean': self.global_mean,
+                'biased': self.biased, 'rating_scale': self.rating_scale}
+    
+    def score_users(self, user_idx):
+        """
+        Tính điểm mu + bu + bi + P·Qᵀ của một nhóm users (theo inner id, -1 nếu chưa biết)
+        với toàn bộ items, cắt về rating_scale giống surprise.
+        
+        Returns:
+        - np.ndarray (len(user_idx), n_items)
+        """
+        return mf_scores(user_idx, **self._factor_arrays())
+    
     def predict(self, user_id, item_id):
         """
         Dự đoán mức độ yêu thích của user đối với item.
         """
-        return self.model.predict(user_id, item_id).est
+        return self.predict_batch([user_id], [item_id])[0]
     
-    def recommend(self, user_id, top_n=5):
+    def _add_ids(self, user_ids, item_ids, rng):
         """
-        Gợi ý top N items cho một user dựa trên dự đoán của mô hình.
+        Thêm users/items mới (khởi tạo factors như surprise: N(init_mean, init_std_dev), bias 0)
+        và trả về inner id của các cặp.
+        """
+        user_ids, item_ids = np.asarray(user_ids), np.asarray(item_ids)
+        new_users = pd.unique(user_ids[self._user_index.get_indexer(user_ids) < 0])
+        new_items = pd.unique(item_ids[self._item_index.get_indexer(item_ids) < 0])
+        
+        if len(new_users):
+            self.user_ids = np.concatenate([self.user_ids, new_users])
+            self._user_index = pd.Index(self.user_ids)
+            self.pu = np.vstack([self.pu, rng.normal(self.model.init_mean, self.model.init_std_dev, (len(new_users), self.n_factors))])
+            self.bu = np.concatenate([self.bu, np.zeros(len(new_users))])
+        if len(new_items):
+            self.item_ids = np.concatenate([self.item_ids, new_items])
+            self._item_index = pd.Index(self.item_ids)
+            self.qi = np.vstack([self.qi, rng.normal(self.model.init_mean, self.model.init_std_dev, (len(new_items), self.n_factors))])
+            self.bi = np.concatenate([self.bi, np.zeros(len(new_items))])
+        if len(new_users) or len(new_items):
+            self.seen.resize((len(self.user_ids), len(self.item_ids)))
+        
+        return self._user_index.get_indexer(user_ids), self._item_index.get_indexer(item_ids)
+    
+    def _sgd_step(self, u, i, r):
+        """
+        Một bước SGD mini-batch với cùng luật cập nhật và siêu tham số của surprise.SVD.
+        """
+        model = self.model
+        pu, qi = self.pu[u], self.qi[i]
+        dot = np.einsum('ij,ij->i', qi, pu)
+        est = self.global_mean + self.bu[u] + self.bi[i] + dot if self.biased else dot
+        err = r - est
+        
+        if self.biased:
+            np.add.at(self.bu, u, model.lr_bu * (err - model.reg_bu * self.bu[u]))
+            np.add.at(self.bi, i, model.lr_bi * (err - model.reg_bi * self.bi[i]))
+        np.add.at(self.pu, u, model.lr_pu * (err[:, None] * qi - model.reg_pu * pu))
+        np.add.at(self.qi, i, model.lr_qi * (err[:, None] * pu - model.reg_qi * qi))
+    
+    @metrics.timed('mf.partial_fit')
+    def partial_fit(self, user_ids, item_ids, ratings, n_epochs=3, replay_ratio=1.0, batch_size=1024, random_state=None,
+                    mark_seen=True):
         """
-        all_items = set(self.ratings_df['itemID'].unique())
-        rated_items = set(self.ratings_df[self.ratings_df['userID'] == user_id]['itemID'].values)
+        Huấn luyện tiếp (warm-start) từ factors hiện tại với các ratings mới, ví dụ nhãn giả của một vòng Co-Training,
+        thay vì fit lại SVD từ đầu.
         
-        candidates = all_items - rated_items  # Chỉ xét các items chưa được đánh giá
-        scores = [(item, self.predict(user_id, item)) for item in candidates]
+        Parameters:
+        - user_ids, item_ids, ratings: các ratings mới
+        - n_epochs: số epoch SGD
+        - replay_ratio: số mẫu lấy ngẫu nhiên từ tập đã học, tính theo tỉ lệ với số ratings mới, để tránh quên
+        - batch_size: kích thước mini-batch SGD
+        - random_state: seed cho việc lấy mẫu replay và xáo trộn
+        - mark_seen: đánh dấu các cặp mới là đã thấy (không gợi ý lại); False cho nhãn giả, vốn chỉ dùng
+          để cập nhật factors - các cặp vẫn được thêm vào tập replay
+        """
+        rng = np.random.default_rng(random_state)
+        u, i = self._add_ids(user_ids, item_ids, rng)
+        r = np.asarray(ratings, dtype=np.float64)
+        
+        n_replay = min(int(len(r) * replay_ratio), len(self._train_ratings))
+        replay = rng.choice(len(self._train_ratings), n_replay, replace=False)
+        train_u = np.concatenate([u, self._train_users[replay]])
+        train_i = np.concatenate([i, self._train_items[replay]])
+        train_r = np.concatenate([r, self._train_ratings[replay]])
+        
+        for _ in range(n_epochs):
+            order = rng.permutation(len(train_r))
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start + batch_size]
+                self._sgd_step(train_u[batch], train_i[batch], train_r[batch])
+        
+        self._remember(u, i, r, mark_seen)
+        return self
+    
+    def _remember(self, u, i, r, mark_seen=True):
+        """
+        Thêm các ratings đã học (theo inner id) vào tập replay và (nếu mark_seen) ma trận seen.
+        """
+        self._train_users = np.concatenate([self._train_users, u])
+        self._train_items = np.concatenate([self._train_items, i])
+        self._train_ratings = np.concatenate([self._train_ratings, r])
+        if not mark_seen:
+            return
+        new_seen = csr_matrix((np.ones(len(u), dtype=np.bool_), (u, i)), shape=self.seen.shape)
+        self.seen = (self.seen + new_seen).astype(np.bool_).tocsr()
+    
+    def get_state(self):
+        """
+        Trạng thái đã học (ids theo inner id, factors, biases) dưới dạng dict mảng, dùng cho checkpoint.
+        """
+        return {'user_ids': self.user_ids, 'item_ids': self.item_ids,
+                'pu': self.pu, 'qi': self.qi, 'bu': self.bu, 'bi': self.bi}
+    
+    def set_state(self, state, extra_ratings=None, mark_seen=True):
+        """
+        Khôi phục trạng thái từ get_state trên một recommender dựng từ cùng ratings_df.
+        
+        Parameters:
+        - state: dict từ get_state
+        - extra_ratings: (tùy chọn) (user_ids, item_ids, ratings) đã học sau ratings_df, ví dụ nhãn giả
+          của các vòng Co-Training, được thêm lại vào tập replay
+        - mark_seen: cùng ý nghĩa với partial_fit - có đánh dấu extra_ratings là đã thấy hay không
+        """
+        if state['pu'].shape[1] != self.n_factors:
+            raise ValueError(f"Checkpoint has {state['pu'].shape[1]} factors, model has {self.n_factors}")
+        train_users = self.user_ids[self._train_users]
+        train_items = self.item_ids[self._train_items]
+        
+        self.user_ids, self.item_ids = np.asarray(state['user_ids']), np.asarray(state['item_ids'])
+        self._user_index = pd.Index(self.user_ids)
+        self._item_index = pd.Index(self.item_ids)
+        self.pu = np.array(state['pu'], dtype=np.float64)
+        self.qi = np.array(state['qi'], dtype=np.float64)
+        self.bu = np.array(state['bu'], dtype=np.float64)
+        self.bi = np.array(state['bi'], dtype=np.float64)
+        
+        self._train_users = self._user_index.get_indexer(train_users)
+        self._train_items = self._item_index.get_indexer(train_items)
+        self.seen = csr_matrix((np.ones(len(self._train_users), dtype=np.bool_), (self._train_users, self._train_items)),
+                               shape=(len(self.user_ids), len(self.item_ids)))
+        self.seen.sum_duplicates()
+        if extra_ratings is not None:
+            user_ids, item_ids, ratings = extra_ratings
+            self._remember(self._user_index.get_indexer(np.asarray(user_ids)),
+                           self._item_index.get_indexer(np.asarray(item_ids)),
+                           np.asarray(ratings, dtype=np.float64), mark_seen)
+        return self
+    
+    @metrics.timed('mf.recommend_batch')
+    def recommend_batch(self, user_ids, top_n=5, batch_size=1024):
+        """
+        Gợi ý top N items cho nhiều users (ví dụ sinh gợi ý offline cho toàn bộ học sinh mỗi đêm).
+        
+        Returns:
+        - list (cùng thứ tự user_ids) các list [(item_id, score)]
+        """
+        user_idx = self._user_index.get_indexer(np.asarray(user_ids))
+        results = []
+        
+        for start in range(0, len(user_idx), batch_size):
+            batch = user_idx[start:start + batch_size]
+            scores = self.score_users(batch)
+            known = batch >= 0
+            # User chưa biết chưa đánh giá item nào nên chỉ cần che các users đã biết
+            scores[known] = mask_seen(scores[known], self.seen[batch[known]])
+            for row_scores, top in zip(scores, top_n_indices(scores, top_n)):
+                results.append([(self.item_ids[i], row_scores[i]) for i in top])
         
-        scores.sort(key=lambda x: x[1], reverse=True)
-        return scores[:top_n]
+        return results
+    
+    def recommend(self, user_id, top_n=5):
+        """
+        Gợi ý top N items cho một user dựa trên dự đoán của mô hình.
+        """
+        return self.recommend_batch([user_id], top_n)[0]
     
 if __name__ == "__main__":
     # Constant
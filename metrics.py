@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lớp đo đạc nhẹ cho pipeline: timers, counters, chuỗi giá trị và ảnh chụp bộ nhớ.
+
+Mặc định tắt: timer() trả về một context rỗng dùng chung và các hàm ghi chỉ kiểm tra một cờ,
+nên chi phí khi tắt gần như bằng 0. Bật/tắt lúc chạy bằng enable() / disable(), xuất ra JSON bằng export().
+
+    import metrics
+    metrics.enable(profile_stage='mf.fit')     # chạy cProfile riêng cho giai đoạn mf.fit
+    ...
+    metrics.export('metrics.json')
+
+Tên dùng trong repo:
+- timers: preprocessing.*, embedding.generate, embedding.encode_batch, content.build_user_profiles,
+  content.update_user_profiles, content.recommend_batch, mf.fit, mf.partial_fit, mf.recommend_batch,
+  co_training.round, co_training.score
+- counters: <cache>.hits / <cache>.misses (preprocessing.cache, embedding.cache, serving.cache)
+- series (mỗi vòng một giá trị): co_training.pairs_per_second, co_training.passed, co_training.added
+"""
+
+import cProfile
+import functools
+import io
+import json
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import nullcontext
+from pathlib import Path
+
+_enabled = False
+_lock = threading.Lock()
+_timers = {}
+_counters = {}
+_series = {}
+_memory = []
+_profiles = {}
+_options = {'track_memory': False, 'profile_stage': None, 'profile_mode': 'cprofile', 'profile_top': 25}
+_NULL = nullcontext()
+
+def enable(track_memory=False, profile_stage=None, profile_mode='cprofile', profile_top=25):
+    """
+    Bật đo đạc.
+
+    Parameters:
+    - track_memory: chụp bộ nhớ (RSS, tracemalloc nếu đang bật) khi mỗi timer kết thúc
+    - profile_stage: tên một timer cần phân tích sâu
+    - profile_mode: 'cprofile' (thời gian theo hàm) hoặc 'tracemalloc' (vị trí cấp phát bộ nhớ)
+    - profile_top: số dòng giữ lại trong kết quả phân tích
+    """
+    global _enabled
+    if profile_mode not in ('cprofile', 'tracemalloc'):
+        raise ValueError(f"profile_mode must be 'cprofile' or 'tracemalloc', got {profile_mode}")
+    _options.update(track_memory=track_memory, profile_stage=profile_stage, profile_mode=profile_mode,
+                    profile_top=profile_top)
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def is_enabled():
+    return _enabled
+
+def reset():
+    """Xóa mọi số liệu đã ghi (giữ nguyên trạng thái bật/tắt)"""
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _series.clear()
+        _memory.clear()
+        _profiles.clear()
+
+def count(name, value=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def record(name, value):
+    """Thêm một giá trị vào chuỗi name (ví dụ một giá trị mỗi vòng Co-Training)"""
+    if not _enabled:
+        return
+    with _lock:
+        _series.setdefault(name, []).append(value)
+
+def _add_duration(name, seconds):
+    with _lock:
+        stats = _timers.get(name)
+        if stats is None:
+            _timers[name] = {'count': 1, 'total': seconds, 'min': seconds, 'max': seconds}
+        else:
+            stats['count'] += 1
+            stats['total'] += seconds
+            stats['min'] = min(stats['min'], seconds)
+            stats['max'] = max(stats['max'], seconds)
+
+def _rss_mb():
+    # RSS hiện tại từ /proc (Linux); nơi khác trả về None
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / (1024 * 1024)
+    except OSError:
+        return None
+
+def memory_snapshot(label):
+    """Ghi RSS hiện tại, peak RSS và (nếu tracemalloc đang chạy) bộ nhớ Python đang dùng / đỉnh"""
+    if not _enabled:
+        return
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    snapshot = {'label': label, 'time': time.time(), 'rss_mb': _rss_mb(),
+                'peak_rss_mb': peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024}
+    if tracemalloc.is_tracing():
+        current, traced_peak = tracemalloc.get_traced_memory()
+        snapshot.update(traced_mb=current / (1024 * 1024), traced_peak_mb=traced_peak / (1024 * 1024))
+    with _lock:
+        _memory.append(snapshot)
+
+class _Profile:
+    def __init__(self, name):
+        self.name = name
+        self.mode = _options['profile_mode']
+        self._profiler = None
+        self._started_tracing = False
+
+    def start(self):
+        if self.mode == 'cprofile':
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def stop(self):
+        top = _options['profile_top']
+        if self.mode == 'cprofile':
+            self._profiler.disable()
+            stats = pstats.Stats(self._profiler, stream=io.StringIO()).sort_stats('cumulative')
+            rows = [{'function': f'{path}:{line}({function})', 'ncalls': calls, 'tottime': tottime, 'cumtime': cumtime}
+                    for (path, line, function), (_, calls, tottime, cumtime, _) in stats.stats.items()]
+            result = sorted(rows, key=lambda row: row['cumtime'], reverse=True)[:top]
+        else:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            result = {'peak_mb': peak / (1024 * 1024),
+                      'top': [{'location': str(stat.traceback), 'size_kb': stat.size / 1024, 'count': stat.count}
+                              for stat in snapshot.statistics('lineno')[:top]]}
+            if self._started_tracing:
+                tracemalloc.stop()
+        with _lock:
+            _profiles[self.name] = {'mode': self.mode, 'result': result}
+
+class _Timer:
+    def __init__(self, name):
+        self.name = name
+        self.seconds = None
+        self._profile = _Profile(name) if name == _options['profile_stage'] else None
+
+    def __enter__(self):
+        if self._profile is not None:
+            self._profile.start()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self._start
+        if self._profile is not None:
+            self._profile.stop()
+        _add_duration(self.name, self.seconds)
+        if _options['track_memory']:
+            memory_snapshot(self.name)
+        return False
+
+def timer(name):
+    """
+    Context manager đo thời gian khối lệnh dưới tên name; khi tắt trả về context rỗng (không đo).
+    """
+    return _Timer(name) if _enabled else _NULL
+
+def timed(name=None):
+    """
+    Decorator: đo thời gian mỗi lần gọi hàm (mặc định dùng tên module.qualname).
+    """
+    def decorator(func):
+        label = name or f'{func.__module__}.{func.__qualname__}'
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Timer(label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def export(path=None):
+    """
+    Trả về (và nếu có path thì ghi ra JSON) toàn bộ số liệu; timers kèm giá trị trung bình,
+    các cặp counters <name>.hits / <name>.misses kèm hit_rate.
+    """
+    with _lock:
+        timers = {name: {**stats, 'mean': stats['total'] / stats['count']} for name, stats in _timers.items()}
+        counters = dict(_counters)
+        report = {'enabled': _enabled, 'timers': timers, 'counters': counters,
+                  'series': {name: list(values) for name, values in _series.items()},
+                  'memory': list(_memory), 'profiles': dict(_profiles)}
+    report['hit_rates'] = {name[:-len('.hits')]: counters[name] / (counters[name] + counters.get(name[:-len('.hits')] + '.misses', 0))
+                           for name in counters if name.endswith('.hits')
+                           and counters[name] + counters.get(name[:-len('.hits')] + '.misses', 0) > 0}
+    if path is not None:
+        Path(path).write_text(json.dumps(report, indent=2, default=float))
+    return report
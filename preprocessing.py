@@ -25,13 +25,27 @@ preprocessing for items meta data
     difficulty (theo thang điểm 0-1): Correct_avg đã chuẩn hóa
 """
 
+import hashlib
+import json
+import os
+import numpy as np
 import pandas as pd
-from collections import Counter
+from pathlib import Path
+import metrics
+
+CACHE_VERSION = 1
 
 class preprocessing_meta_data:
-    def __init__(self, file_path, nrows=None, cols_needed=["problem_id", "sequence_id", "skill", "problem_type", "type", "correct"], sequence_id_list=None):
-        self.df = pd.read_csv(file_path, usecols=cols_needed, nrows=nrows)
+    @metrics.timed('preprocessing.meta_data.read')
+    def __init__(self, file_path=None, nrows=None, cols_needed=["problem_id", "sequence_id", "skill", "problem_type", "type", "correct"], sequence_id_list=None, stream=None):
         self.dict = {}
+        self.aggregates = None
+        if stream is not None:
+            # Dùng các bảng tổng hợp đã tính trong một lần đọc file (preprocessing_stream)
+            self.aggregates = stream.run().meta_aggregates(sequence_id_list)
+            return
+        
+        self.df = pd.read_csv(file_path, usecols=cols_needed, nrows=nrows)
         if sequence_id_list:
             self.sequence_id_list = sequence_id_list
             self.df = self.df[self.df["sequence_id"].isin(sequence_id_list)]
@@ -50,45 +64,59 @@ class preprocessing_meta_data:
         self.df["skill"] = self.df["skill"].fillna("Unknown")
         
     def group_by_sequence(self):
-        self.df = self.df.groupby("sequence_id").agg({
-            "skill": list,
-            "problem_type": list,
-            "type": "first",
-            "correct_avg": "mean",
-            "problem_id": "count"
-        }).reset_index()
-        
-        self.df.rename(columns={"problem_id": "amount"}, inplace=True)
-        self.df.rename(columns={"correct_avg": "difficulty"}, inplace=True)
-        self.df.rename(columns={"skill": "topic"}, inplace=True)
-        self.df.rename(columns={"type": "sequence_type"}, inplace=True)
-        
-        # convert list type -> dict type with amount
-        self.df["topic"] = self.df["topic"].apply(lambda x: dict(Counter(x)))
-        self.df["problem_type"] = self.df["problem_type"].apply(lambda x: dict(Counter(x)))
-        
-        # convert dict type -> list type (ordered)
-        self.df["topic"] = self.df["topic"].apply(lambda x: sorted(x, key=x.get, reverse=True) if isinstance(x, dict) else x)
-        
-        # binning diffculty
-        self.df["difficulty"] = pd.cut(
-            self.df["difficulty"],
-            bins=[0, 0.2, 0.4, 0.6, 0.8, 1],
-            labels=["Very Hard", "Hard", "Normal", "Easy", "Very Easy"],
-            include_lowest=True
-        )
-    
-    def convert_df_to_dict(self):
+        if self.aggregates is None:
+            rows = self.df.rename(columns={"correct_avg": "correct"})
+            rows["row"] = np.arange(len(rows))
+            self.aggregates = aggregate_rows(rows)[1:]
+        
+        # Đếm bằng groupby(...).size() thay vì list + Counter + sorted theo từng dòng
+        self.columns = sequence_columns(*self.aggregates)
+        self.df = columns_to_frame(self.columns)
+    
+    def convert_df_to_dict(self, columnar=False):
+        if columnar:
+            # Dạng cột gọn: mảng phẳng + offsets, không tạo dict lồng cho từng sequence
+            self.dict = self.columns
+            return
         self.dict = self.df.set_index("sequence_id").to_dict(orient="index")
     
-    def process(self):
+    @metrics.timed('preprocessing.meta_data')
+    def process(self, columnar=False):
         self.group_by_sequence()
-        self.convert_df_to_dict()
+        self.convert_df_to_dict(columnar)
         
         return self.dict
     
+    @classmethod
+    def load_or_process(cls, file_path=None, nrows=None, sequence_id_list=None, stream=None, cache_dir='data_save/cache'):
+        """
+        Trả về dict meta data theo sequence, đọc từ cache nếu nguồn và tham số không đổi,
+        ngược lại tính lại (qua stream nếu có) và ghi cache.
+        """
+        if stream is not None:
+            file_path, nrows = stream.file_path, stream.nrows
+        path = cache_path(cache_dir, "meta", file_path, nrows=nrows, sequence_ids=ids_digest(sequence_id_list))
+        if path.exists():
+            metrics.count('preprocessing.cache.hits')
+            with np.load(path, allow_pickle=False) as data:
+                return columns_to_meta_dict(data)
+        metrics.count('preprocessing.cache.misses')
+        
+        if stream is not None:
+            columns = cls(sequence_id_list=sequence_id_list, stream=stream).process(columnar=True)
+        else:
+            columns = cls(file_path=file_path, nrows=nrows, sequence_id_list=sequence_id_list).process(columnar=True)
+        save_npz(path, columns)
+        return columns_to_meta_dict(columns)
+    
 class preprocessing_matrix:
-    def __init__(self, file_path, nrows=None, cols_needed=['user_id', 'sequence_id', 'correct']):
+    @metrics.timed('preprocessing.matrix')
+    def __init__(self, file_path=None, nrows=None, cols_needed=['user_id', 'sequence_id', 'correct'], stream=None):
+        if stream is not None:
+            # Ma trận user x sequence đã được tính trong một lần đọc file (preprocessing_stream)
+            self.df = stream.run().matrix_df.copy()
+            return
+        
         self.df = pd.read_csv(file_path, usecols=cols_needed, nrows=nrows)
         
         # Group by assignment_id và user_id, tính trung bình của cột correct
@@ -106,7 +134,32 @@ class preprocessing_matrix:
         
     def filter_matrix(self, threshold=2):
         # Binarize the data (only keep ratings >= threshold)
-        self.df = self.df[self.df['rating'] >= 2]
+        self.df = self.df[self.df['rating'] >= threshold]
+    
+    @classmethod
+    def load_or_process(cls, file_path=None, nrows=None, threshold=2, stream=None, cache_dir='data_save/cache'):
+        """
+        Trả về preprocessing_matrix đã reverse_correct và filter_matrix(threshold), đọc từ cache
+        nếu nguồn và tham số không đổi, ngược lại tính lại (qua stream nếu có) và ghi cache.
+        """
+        if stream is not None:
+            file_path, nrows = stream.file_path, stream.nrows
+        path = cache_path(cache_dir, "matrix", file_path, nrows=nrows, threshold=threshold)
+        if path.exists():
+            metrics.count('preprocessing.cache.hits')
+            pre = cls.__new__(cls)
+            with np.load(path, allow_pickle=False) as data:
+                pre.df = pd.DataFrame({"userID": data["userID"], "itemID": data["itemID"], "rating": data["rating"]},
+                                      index=data["index"])
+            return pre
+        metrics.count('preprocessing.cache.misses')
+        
+        pre = cls(stream=stream) if stream is not None else cls(file_path=file_path, nrows=nrows)
+        pre.reverse_correct()
+        pre.filter_matrix(threshold)
+        save_npz(path, {"userID": pre.df["userID"].to_numpy(), "itemID": pre.df["itemID"].to_numpy(),
+                        "rating": pre.df["rating"].to_numpy(), "index": pre.df.index.to_numpy()})
+        return pre
     
     def extract_sequence_id(self):
         try:
@@ -116,6 +169,255 @@ class preprocessing_matrix:
         
         return list(unique_values)
 
+def file_fingerprint(file_path, sample_size=1 << 20):
+    # Kích thước, thời điểm sửa và hash của đoạn đầu/cuối file: đủ để phát hiện file nguồn thay đổi
+    stat = os.stat(file_path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        digest.update(f.read(sample_size))
+        if stat.st_size > sample_size:
+            f.seek(-sample_size, os.SEEK_END)
+            digest.update(f.read(sample_size))
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sample": digest.hexdigest()}
+
+def ids_digest(ids):
+    if not ids:
+        return None
+    return hashlib.blake2b(np.unique(np.asarray(ids, dtype=np.int64)).tobytes(), digest_size=16).hexdigest()
+
+def cache_path(cache_dir, kind, file_path, **params):
+    payload = json.dumps({"version": CACHE_VERSION, "kind": kind, "source": file_fingerprint(file_path),
+                          "params": params}, sort_keys=True)
+    return Path(cache_dir) / f"{kind}-{hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()}.npz"
+
+def save_npz(path, arrays):
+    # Ghi ra file tạm rồi os.replace để không bao giờ để lại cache hỏng
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp.npz")
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+def _strings(values):
+    values = pd.Series(list(values), dtype=object)
+    return values.fillna("").astype(str).to_numpy(dtype=str), values.isna().to_numpy()
+
+def _restore(values, na):
+    return [np.nan if missing else value for value, missing in zip(values.tolist(), na.tolist())]
+
+def meta_dict_to_columns(items):
+    """
+    Chuyển dict meta data {sequence_id: {...}} sang dạng cột: mảng phẳng + offsets cho topic và problem_type.
+    """
+    records = list(items.values())
+    topics = [record["topic"] for record in records]
+    problem_types = [record["problem_type"] for record in records]
+    
+    columns = {
+        "sequence_id": np.asarray(list(items.keys()), dtype=np.int64),
+        "topic_offsets": np.cumsum([0] + [len(topic) for topic in topics]),
+        "problem_type_offsets": np.cumsum([0] + [len(problem_type) for problem_type in problem_types]),
+        "problem_type_count": np.asarray([count for problem_type in problem_types for count in problem_type.values()], dtype=np.int64),
+        "amount": np.asarray([record["amount"] for record in records], dtype=np.int64)
+    }
+    for name, values in [("topic", [value for topic in topics for value in topic]),
+                         ("problem_type", [key for problem_type in problem_types for key in problem_type]),
+                         ("sequence_type", [record["sequence_type"] for record in records]),
+                         ("difficulty", [record["difficulty"] for record in records])]:
+        columns[name], columns[f"{name}_na"] = _strings(values)
+    return columns
+
+def columns_to_meta_dict(columns):
+    topic = _restore(columns["topic"], columns["topic_na"])
+    problem_type = _restore(columns["problem_type"], columns["problem_type_na"])
+    problem_type_count = columns["problem_type_count"].tolist()
+    sequence_type = _restore(columns["sequence_type"], columns["sequence_type_na"])
+    difficulty = _restore(columns["difficulty"], columns["difficulty_na"])
+    topic_offsets = columns["topic_offsets"].tolist()
+    problem_type_offsets = columns["problem_type_offsets"].tolist()
+    
+    items = {}
+    for row, (sequence_id, amount) in enumerate(zip(columns["sequence_id"].tolist(), columns["amount"].tolist())):
+        start, end = problem_type_offsets[row], problem_type_offsets[row + 1]
+        items[sequence_id] = {
+            "topic": topic[topic_offsets[row]:topic_offsets[row + 1]],
+            "problem_type": dict(zip(problem_type[start:end], problem_type_count[start:end])),
+            "sequence_type": sequence_type[row],
+            "difficulty": difficulty[row],
+            "amount": amount
+        }
+    return items
+
+def bin_difficulty(difficulty):
+    # binning diffculty
+    return pd.cut(
+        difficulty,
+        bins=[0, 0.2, 0.4, 0.6, 0.8, 1],
+        labels=["Very Hard", "Hard", "Normal", "Easy", "Very Easy"],
+        include_lowest=True
+    )
+
+def aggregate_rows(df):
+    """
+    Tổng hợp một bảng dòng (sequence_id, user_id, problem_id, skill, problem_type, type, correct, row)
+    thành các bảng có thể gộp tiếp: ma trận (sequence, user), thống kê theo sequence,
+    số lần xuất hiện (kèm dòng đầu tiên) của mỗi skill / problem_type trong sequence.
+    """
+    matrix = None
+    if "user_id" in df:
+        matrix = df.groupby(["sequence_id", "user_id"]).agg(correct_sum=("correct", "sum"),
+                                                            correct_count=("correct", "count"))
+    
+    stats = df.groupby("sequence_id").agg(correct_sum=("correct", "sum"),
+                                          correct_count=("correct", "count"),
+                                          amount=("problem_id", "count"))
+    typed = df.dropna(subset=["type"]).groupby("sequence_id").head(1).set_index("sequence_id")
+    stats["sequence_type"] = typed["type"].astype(object).reindex(stats.index)
+    stats["type_row"] = typed["row"].reindex(stats.index)
+    
+    return matrix, _count_values(df, "skill"), _count_values(df, "problem_type"), stats
+
+def _count_values(df, column):
+    counts = df.groupby(["sequence_id", column], observed=True, dropna=False).agg(
+        count=("sequence_id", "size"), first_row=("row", "min")).reset_index()
+    counts[column] = counts[column].astype(object)
+    return counts
+
+def _offsets(sequence_ids, counts):
+    # counts đã lọc theo sequence_ids và sắp theo sequence_id: vị trí bắt đầu của từng sequence + tổng số dòng
+    return np.append(np.searchsorted(counts["sequence_id"].to_numpy(), sequence_ids), len(counts))
+
+def sequence_columns(skill_counts, problem_type_counts, sequence_stats):
+    """
+    Kết quả của group_by_sequence ở dạng cột (cùng định dạng với meta_dict_to_columns):
+    - topic: skill xếp theo số câu giảm dần, hòa thì theo thứ tự xuất hiện (giống sorted ổn định trên Counter)
+    - problem_type / problem_type_count: theo thứ tự xuất hiện trong sequence
+    Mọi bước đều là sort/searchsorted trên mảng, không có lambda theo từng dòng.
+    """
+    sequence_stats = sequence_stats.sort_index()
+    sequence_ids = sequence_stats.index.to_numpy()
+    skill_counts = skill_counts[skill_counts["sequence_id"].isin(sequence_ids)].sort_values(
+        ["sequence_id", "count", "first_row"], ascending=[True, False, True], kind="stable")
+    problem_type_counts = problem_type_counts[problem_type_counts["sequence_id"].isin(sequence_ids)].sort_values(
+        ["sequence_id", "first_row"], kind="stable")
+    
+    difficulty = bin_difficulty(sequence_stats["correct_sum"] / sequence_stats["correct_count"])
+    columns = {
+        "sequence_id": sequence_ids.astype(np.int64),
+        "topic_offsets": _offsets(sequence_ids, skill_counts),
+        "problem_type_offsets": _offsets(sequence_ids, problem_type_counts),
+        "problem_type_count": problem_type_counts["count"].to_numpy(dtype=np.int64),
+        "amount": sequence_stats["amount"].to_numpy(dtype=np.int64)
+    }
+    for name, values in [("topic", skill_counts["skill"]),
+                         ("problem_type", problem_type_counts["problem_type"]),
+                         ("sequence_type", sequence_stats["sequence_type"]),
+                         ("difficulty", difficulty.astype(object))]:
+        columns[name], columns[f"{name}_na"] = _strings(values)
+    return columns
+
+def columns_to_frame(columns):
+    # DataFrame giống đầu ra cũ của group_by_sequence (topic là list, problem_type là dict)
+    items = columns_to_meta_dict(columns)
+    df = pd.DataFrame.from_dict(items, orient="index")
+    df.index.name = "sequence_id"
+    df = df.reset_index()
+    df["difficulty"] = pd.Categorical(df["difficulty"], categories=["Very Hard", "Hard", "Normal", "Easy", "Very Easy"],
+                                      ordered=True)
+    return df
+
+class preprocessing_stream:
+    """
+    Đọc assistment_2012_2013.csv một lần theo từng chunk với dtype gọn, đồng thời tính:
+    - ma trận user x sequence (trung bình correct) cho preprocessing_matrix
+    - các bảng tổng hợp theo sequence cho preprocessing_meta_data
+    Mỗi chunk chỉ sinh ra bảng tổng hợp một phần (sum/count/first_row); các bảng này được gộp
+    định kỳ nên bộ nhớ đỉnh phụ thuộc vào chunksize và số khóa phân biệt, không phụ thuộc kích thước file.
+    """
+    dtypes = {
+        "user_id": "int32",
+        "sequence_id": "int32",
+        "problem_id": "int32",
+        "skill": "category",
+        "problem_type": "category",
+        "type": "category",
+        "correct": "float32"
+    }
+    
+    def __init__(self, file_path, nrows=None, chunksize=1_000_000, merge_every=8):
+        self.file_path = file_path
+        self.nrows = nrows
+        self.chunksize = chunksize
+        self.merge_every = merge_every
+        self.matrix_df = None
+        self.skill_counts = None
+        self.problem_type_counts = None
+        self.sequence_stats = None
+    
+    @staticmethod
+    def _merge_counts(parts, column):
+        merged = pd.concat(parts, ignore_index=True)
+        return merged.groupby(["sequence_id", column], dropna=False).agg(
+            count=("count", "sum"), first_row=("first_row", "min")).reset_index()
+    
+    @staticmethod
+    def _merge_stats(parts):
+        merged = pd.concat(parts)
+        stats = merged.groupby(level=0).agg(correct_sum=("correct_sum", "sum"),
+                                            correct_count=("correct_count", "sum"),
+                                            amount=("amount", "sum"))
+        # type "first": giá trị khác NaN xuất hiện sớm nhất
+        first_type = merged.dropna(subset=["sequence_type"]).sort_values("type_row")
+        first_type = first_type[~first_type.index.duplicated(keep="first")]
+        stats["sequence_type"] = first_type["sequence_type"].reindex(stats.index)
+        stats["type_row"] = first_type["type_row"].reindex(stats.index)
+        return stats
+    
+    @staticmethod
+    def _merge_matrix(parts):
+        merged = pd.concat(parts)
+        return merged.groupby(level=[0, 1]).sum()
+    
+    def _aggregate_chunk(self, chunk):
+        chunk["row"] = chunk.index
+        chunk["skill"] = chunk["skill"].astype(object).fillna("Unknown")
+        matrix, skill_counts, problem_type_counts, stats = aggregate_rows(chunk)
+        return (matrix, stats, skill_counts, problem_type_counts)
+    
+    @metrics.timed('preprocessing.stream')
+    def run(self):
+        if self.matrix_df is not None:
+            return self
+        
+        reader = pd.read_csv(self.file_path, usecols=list(self.dtypes), dtype=self.dtypes,
+                             nrows=self.nrows, chunksize=self.chunksize)
+        parts = [[], [], [], []]
+        mergers = [self._merge_matrix, self._merge_stats,
+                   lambda x: self._merge_counts(x, "skill"), lambda x: self._merge_counts(x, "problem_type")]
+        
+        for chunk in reader:
+            for part, partial in zip(parts, self._aggregate_chunk(chunk)):
+                part.append(partial)
+            if len(parts[0]) >= self.merge_every:
+                parts = [[merge(part)] for merge, part in zip(mergers, parts)]
+        
+        matrix, self.sequence_stats, self.skill_counts, self.problem_type_counts = \
+            [merge(part) for merge, part in zip(mergers, parts)]
+        
+        # Giống groupby(['sequence_id', 'user_id'])['correct'].mean() của preprocessing_matrix
+        matrix = (matrix["correct_sum"] / matrix["correct_count"]).rename("rating").reset_index()
+        self.matrix_df = matrix.rename(columns={"user_id": "userID", "sequence_id": "itemID"})[["userID", "itemID", "rating"]]
+        
+        return self
+    
+    def meta_aggregates(self, sequence_id_list=None):
+        skill_counts, problem_type_counts, sequence_stats = self.skill_counts, self.problem_type_counts, self.sequence_stats
+        if sequence_id_list:
+            skill_counts = skill_counts[skill_counts["sequence_id"].isin(sequence_id_list)]
+            problem_type_counts = problem_type_counts[problem_type_counts["sequence_id"].isin(sequence_id_list)]
+            sequence_stats = sequence_stats[sequence_stats.index.isin(sequence_id_list)]
+        
+        return skill_counts, problem_type_counts, sequence_stats
+
 if __name__ == "__main__":
     # Constant
     cols_needed = ["problem_id", "sequence_id", "skill", "problem_type", "type", "correct"]
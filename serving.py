@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Phục vụ gợi ý trực tuyến từ các ma trận đã tính sẵn.
+
+- ServingModel: ma trận của ContentBasedRecommender và MatrixFactorizationRecommender căn theo cùng một
+  không gian users/items, lưu/tải dạng .npy (memory-mapped), chấm điểm 'content', 'mf' hoặc 'blend'.
+- TopNCache: cache LRU + TTL các danh sách top-N theo user, xóa khi ratings của user thay đổi.
+- RecommendationServer: recommend / recommend_batch qua cache, update_ratings để đánh dấu ratings mới.
+- AsyncRecommendationService: điểm vào asyncio, gom các request đồng thời thành một batch;
+  LocalClient gọi trực tiếp (không qua mạng), serve_tcp phục vụ JSON theo dòng.
+"""
+
+import asyncio
+import json
+import time
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from pathlib import Path
+from scipy.sparse import csr_matrix
+from utils import mask_seen, mf_scores, top_n_indices
+import metrics
+
+MODELS = ('content', 'mf', 'blend')
+
+class ServingModel:
+    def __init__(self, arrays, blend_weight=0.5):
+        """
+        Parameters:
+        - arrays: dict các mảng do from_recommenders / load tạo ra
+        - blend_weight: trọng số của content trong 'blend' (0.5 là trung bình như nhãn giả Co-Training);
+          items content không chấm được (không có embedding) để NaN - không trộn được với thang điểm MF;
+          user content chưa biết thì dùng điểm MF cho cả hàng
+        """
+        self.arrays = arrays
+        self.blend_weight = blend_weight
+        self.item_ids = arrays['item_ids']
+        self.user_ids = arrays['user_ids']
+        self._user_index = pd.Index(self.user_ids)
+        self._item_index = pd.Index(self.item_ids)
+        self.global_mean = float(arrays['global_mean'])
+        self.rating_scale = tuple(arrays['rating_scale'].tolist())
+        self.biased = bool(arrays['biased'])
+        self.seen = csr_matrix((np.ones(len(arrays['seen_indices']), dtype=np.bool_), arrays['seen_indices'],
+                                arrays['seen_indptr']), shape=(len(self.user_ids), len(self.item_ids)))
+        self._extra_seen = {}
+
+    @classmethod
+    def from_recommenders(cls, content_recommender, mf_recommender, blend_weight=0.5):
+        """
+        Căn ma trận của hai mô hình (đã huấn luyện, hoặc sau Co-Training) theo hợp users / items của chúng.
+        Items không có trong một mô hình nhận hàng 0 và được đánh dấu chưa biết.
+        """
+        content, mf = content_recommender, mf_recommender
+        item_ids = np.concatenate([content.item_ids, mf.item_ids[pd.Index(content.item_ids).get_indexer(mf.item_ids) < 0]])
+        user_ids = np.concatenate([content.user_ids, mf.user_ids[pd.Index(content.user_ids).get_indexer(mf.user_ids) < 0]])
+        item_index, user_index = pd.Index(item_ids), pd.Index(user_ids)
+        content_items = item_index.get_indexer(content.item_ids)
+        mf_items = item_index.get_indexer(mf.item_ids)
+
+        item_matrix = np.zeros((len(item_ids), content.item_matrix.shape[1]), dtype=np.float32)
+        item_matrix[content_items] = content.item_matrix
+        content_item_known = np.zeros(len(item_ids), dtype=bool)
+        content_item_known[content_items] = True
+        qi = np.zeros((len(item_ids), mf.qi.shape[1]))
+        qi[mf_items] = mf.qi
+        bi = np.zeros(len(item_ids))
+        bi[mf_items] = mf.bi
+        mf_item_known = np.zeros(len(item_ids), dtype=bool)
+        mf_item_known[mf_items] = True
+
+        # Hợp các cặp đã đánh giá của hai mô hình, theo chỉ số phục vụ
+        rows, cols = [], []
+        for recommender in (content, mf):
+            coo = recommender.seen.tocoo()
+            rows.append(user_index.get_indexer(recommender.user_ids)[coo.row])
+            cols.append(item_index.get_indexer(recommender.item_ids)[coo.col])
+        seen = csr_matrix((np.ones(sum(len(r) for r in rows), dtype=np.bool_), (np.concatenate(rows), np.concatenate(cols))),
+                          shape=(len(user_ids), len(item_ids)))
+        seen.sum_duplicates()
+
+        arrays = {
+            'item_ids': item_ids,
+            'user_ids': user_ids,
+            'content_users': pd.Index(content.user_ids).get_indexer(user_ids),
+            'user_matrix': content.user_matrix,
+            'item_matrix': item_matrix,
+            'content_item_known': content_item_known,
+            'mf_users': pd.Index(mf.user_ids).get_indexer(user_ids),
+            'pu': mf.pu,
+            'bu': mf.bu,
+            'qi': qi,
+            'bi': bi,
+            'mf_item_known': mf_item_known,
+            'global_mean': np.float64(mf.global_mean),
+            'rating_scale': np.asarray(mf.rating_scale, dtype=np.float64),
+            'biased': np.bool_(mf.biased),
+            'seen_indptr': seen.indptr,
+            'seen_indices': seen.indices,
+        }
+        return cls(arrays, blend_weight)
+
+    def save(self, save_dir='data_save/serving'):
+        """Lưu mỗi mảng thành một file .npy để load có thể memory-map"""
+        Path(save_dir).mkdir(parents=True, exist_ok=True)
+        for key, value in self.arrays.items():
+            np.save(f'{save_dir}/{key}.npy', value)
+        print(f"Saved serving matrices to {save_dir}")
+
+    @classmethod
+    def load(cls, load_dir='data_save/serving', mmap_mode='r', blend_weight=0.5):
+        """Tải các ma trận đã lưu một lần; mặc định memory-mapped nên nhiều process dùng chung page cache"""
+        arrays = {path.stem: np.load(path, mmap_mode=mmap_mode) for path in sorted(Path(load_dir).glob('*.npy'))}
+        print(f"Loaded serving matrices for {len(arrays['user_ids'])} users, {len(arrays['item_ids'])} items")
+        return cls(arrays, blend_weight)
+
+    def mark_seen(self, user_ids, item_ids):
+        """
+        Đánh dấu các cặp (user, item) mới được đánh giá để không gợi ý lại; items chưa biết bị bỏ qua.
+        """
+        item_idx = self._item_index.get_indexer(np.asarray(item_ids))
+        for user_id, item in zip(np.asarray(user_ids).tolist(), item_idx.tolist()):
+            if item >= 0:
+                self._extra_seen.setdefault(user_id, set()).add(item)
+
+    def _content_scores(self, rows):
+        content_rows = np.where(rows >= 0, self.arrays['content_users'][np.maximum(rows, 0)], -1)
+        known = content_rows >= 0
+        scores = np.full((len(rows), len(self.item_ids)), np.nan, dtype=np.float32)
+        scores[known] = (self.arrays['user_matrix'][content_rows[known]] @ self.arrays['item_matrix'].T) * 5
+        scores[:, ~self.arrays['content_item_known']] = np.nan
+        return scores
+
+    def _mf_scores(self, rows):
+        """Cùng công thức với MatrixFactorizationRecommender.score_users (utils.mf_scores)"""
+        mf_rows = np.where(rows >= 0, self.arrays['mf_users'][np.maximum(rows, 0)], -1)
+        return mf_scores(mf_rows, self.arrays['pu'], self.arrays['qi'], self.arrays['bu'], self.arrays['bi'],
+                         self.global_mean, self.biased, self.rating_scale, known_items=self.arrays['mf_item_known'])
+
+    def score(self, user_ids, model='blend'):
+        """
+        Điểm của các users với toàn bộ items.
+
+        Returns:
+        - np.ndarray (len(user_ids), n_items), NaN nơi mô hình không chấm được
+        """
+        if model not in MODELS:
+            raise ValueError(f"model must be one of {MODELS}, got {model}")
+        rows = self._user_index.get_indexer(np.asarray(user_ids))
+        if model == 'content':
+            return self._content_scores(rows)
+        if model == 'mf':
+            return self._mf_scores(rows)
+        mf_scores = self._mf_scores(rows)
+        content_scores = self._content_scores(rows)
+        blended = self.blend_weight * content_scores + (1 - self.blend_weight) * mf_scores
+        # Điểm content (cosine x 5) và MF khác thang nên không thay từng item bằng điểm MF thô;
+        # chỉ user không có hồ sơ content mới dùng MF cho cả hàng
+        no_content = np.isnan(content_scores).all(axis=1)
+        blended[no_content] = mf_scores[no_content]
+        return blended
+
+    def recommend_batch(self, user_ids, top_n=5, model='blend'):
+        """
+        Returns:
+        - list (cùng thứ tự user_ids) các list [(item_id, score)], bỏ các items user đã đánh giá
+        """
+        user_ids = np.asarray(user_ids)
+        rows = self._user_index.get_indexer(user_ids)
+        scores = self.score(user_ids, model)
+        known = rows >= 0
+        scores[known] = mask_seen(scores[known], self.seen[rows[known]])
+        for row, user_id in enumerate(user_ids.tolist()):
+            extra = self._extra_seen.get(user_id)
+            if extra:
+                scores[row, list(extra)] = -np.inf
+        return [[(self.item_ids[i], row_scores[i]) for i in top]
+                for row_scores, top in zip(scores, top_n_indices(scores, top_n))]
+
+class TopNCache:
+    def __init__(self, maxsize=100_000, ttl=300.0, clock=time.monotonic):
+        """
+        Cache LRU + TTL các danh sách top-N, theo user rồi theo model.
+
+        Parameters:
+        - maxsize: số users tối đa; user ít dùng nhất bị loại trước
+        - ttl: số giây một danh sách còn hiệu lực; None là không hết hạn
+        - clock: hàm thời gian (thay được khi kiểm thử)
+
+        Một danh sách top-N lớn hơn cũng trả lời được các request top_n nhỏ hơn.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id, model, top_n):
+        _check_top_n(top_n)
+        entry = self._entries.get(user_id, {}).get(model)
+        if entry is not None:
+            expires, cached_n, result = entry
+            if (expires is None or expires > self.clock()) and (cached_n >= top_n or len(result) < cached_n):
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                metrics.count('serving.cache.hits')
+                return result[:top_n]
+        self.misses += 1
+        metrics.count('serving.cache.misses')
+        return None
+
+    def put(self, user_id, model, top_n, result):
+        expires = None if self.ttl is None else self.clock() + self.ttl
+        self._entries.setdefault(user_id, {})[model] = (expires, top_n, result)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+class RecommendationServer:
+    def __init__(self, model, cache_size=100_000, ttl=300.0):
+        """
+        Parameters:
+        - model: ServingModel
+        - cache_size, ttl: tham số của TopNCache
+        """
+        self.model = model
+        self.cache = TopNCache(cache_size, ttl)
+
+    def recommend_batch(self, user_ids, top_n=5, model='blend'):
+        """
+        Gợi ý cho nhiều users; chỉ các users chưa có trong cache được chấm điểm, trong một phép GEMM.
+        top_n phải là số nguyên dương, user_ids là các id vô hướng (ValueError nếu không).
+        """
+        _check_top_n(top_n)
+        _check_model(model)
+        user_ids = list(np.asarray(user_ids).tolist())
+        for user_id in user_ids:
+            _check_user_id(user_id)
+        results = [self.cache.get(user_id, model, top_n) for user_id in user_ids]
+        missing = [row for row, result in enumerate(results) if result is None]
+        if missing:
+            computed = self.model.recommend_batch([user_ids[row] for row in missing], top_n, model)
+            for row, result in zip(missing, computed):
+                self.cache.put(user_ids[row], model, top_n, result)
+                results[row] = result
+        return results
+
+    def recommend(self, user_id, top_n=5, model='blend'):
+        return self.recommend_batch([user_id], top_n, model)[0]
+
+    def warm(self, user_ids=None, top_n=5, model='blend', batch_size=1024):
+        """Tính sẵn top-N cho các users (mặc định tất cả) để các request sau chỉ đọc cache"""
+        user_ids = self.model.user_ids if user_ids is None else np.asarray(user_ids)
+        for start in range(0, len(user_ids), batch_size):
+            self.recommend_batch(user_ids[start:start + batch_size], top_n, model)
+
+    def update_ratings(self, user_ids, item_ids):
+        """
+        Ghi nhận ratings mới: các items không được gợi ý lại và cache của các users liên quan bị xóa.
+        Khi mô hình được huấn luyện lại, tạo ServingModel mới và gọi reload.
+        """
+        self.model.mark_seen(user_ids, item_ids)
+        for user_id in set(np.asarray(user_ids).tolist()):
+            self.cache.invalidate(user_id)
+
+    def reload(self, model):
+        self.model = model
+        self.cache.clear()
+
+class AsyncRecommendationService:
+    def __init__(self, server, max_batch=256, max_wait=0.001):
+        """
+        Điểm vào asyncio: các request đồng thời được gom (tối đa max_batch, chờ tối đa max_wait giây)
+        và trả lời bằng một lần RecommendationServer.recommend_batch cho mỗi (top_n, model).
+        """
+        self.server = server
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = None
+        self._worker = None
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+        return self
+
+    async def stop(self):
+        """Dừng worker; các request còn trong hàng đợi nhận lỗi thay vì chờ mãi"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+            while not self._queue.empty():
+                *_, future = self._queue.get_nowait()
+                if not future.done():
+                    future.set_exception(RuntimeError("Service stopped"))
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            try:
+                while len(batch) < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+            except asyncio.CancelledError:
+                # stop() trong lúc đang gom: các request đã lấy khỏi hàng đợi cũng nhận lỗi
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(RuntimeError("Service stopped"))
+                raise
+
+            groups = {}
+            for user_id, top_n, model, future in batch:
+                groups.setdefault((top_n, model), []).append((user_id, future))
+            for (top_n, model), requests in groups.items():
+                try:
+                    results = self.server.recommend_batch([user_id for user_id, _ in requests], top_n, model)
+                except Exception:
+                    # Dự phòng: chạy lại từng request để chỉ request lỗi nhận lỗi, không kéo theo cả nhóm
+                    for user_id, future in requests:
+                        try:
+                            result = self.server.recommend(user_id, top_n, model)
+                        except Exception as error:
+                            if not future.done():
+                                future.set_exception(error)
+                        else:
+                            if not future.done():
+                                future.set_result(result)
+                    continue
+                for (_, future), result in zip(requests, results):
+                    if not future.done():
+                        future.set_result(result)
+
+    async def recommend(self, user_id, top_n=5, model='blend'):
+        """Gợi ý cho một user; tham số được kiểm tra trước khi vào hàng đợi (ValueError nếu sai)"""
+        if self._worker is None:
+            raise RuntimeError("Service is not started")
+        _check_user_id(user_id)
+        _check_top_n(top_n)
+        _check_model(model)
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((user_id, top_n, model, future))
+        return await future
+
+    async def handle(self, request):
+        """
+        Xử lý một request dạng dict {'user_id', 'top_n', 'model'} hoặc {'user_ids', ...} (batch),
+        trả về dict có thể chuyển sang JSON; request sai kiểu nhận {'error': ...}.
+        """
+        try:
+            top_n = request.get('top_n', 5)
+            model = request.get('model', 'blend')
+            _check_top_n(top_n)
+            _check_model(model)
+            if 'user_ids' in request:
+                if not isinstance(request['user_ids'], list):
+                    raise ValueError("user_ids must be a list")
+                for user_id in request['user_ids']:
+                    _check_user_id(user_id)
+                results = await asyncio.gather(*(self.recommend(user_id, top_n, model) for user_id in request['user_ids']))
+                return {'user_ids': request['user_ids'], 'items': [_to_json(result) for result in results]}
+            result = await self.recommend(request['user_id'], top_n, model)
+            return {'user_id': request['user_id'], 'items': _to_json(result)}
+        except KeyError as error:
+            return {'error': f"Missing field: {error}"}
+        except ValueError as error:
+            return {'error': str(error)}
+
+    async def serve_tcp(self, host='127.0.0.1', port=8765):
+        """Phục vụ qua TCP, mỗi dòng là một request JSON và một response JSON"""
+        async def on_connection(reader, writer):
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                except json.JSONDecodeError as error:
+                    response = {'error': f"Invalid JSON: {error}"}
+                else:
+                    try:
+                        response = (await self.handle(request) if isinstance(request, dict)
+                                    else {'error': "Request must be a JSON object"})
+                    except Exception as error:
+                        # Một request lỗi không bao giờ được đóng kết nối
+                        response = {'error': f"{type(error).__name__}: {error}"}
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+            writer.close()
+
+        server = await asyncio.start_server(on_connection, host, port)
+        async with server:
+            await server.serve_forever()
+
+class LocalClient:
+    def __init__(self, service):
+        """Client thay thế chạy cùng event loop, gửi request dạng dict thẳng vào service (không qua mạng)"""
+        self.service = service
+
+    async def recommend(self, user_id, top_n=5, model='blend'):
+        return await self.service.handle({'user_id': user_id, 'top_n': top_n, 'model': model})
+
+    async def recommend_batch(self, user_ids, top_n=5, model='blend'):
+        return await self.service.handle({'user_ids': list(user_ids), 'top_n': top_n, 'model': model})
+
+def _check_top_n(top_n):
+    if isinstance(top_n, bool) or not isinstance(top_n, (int, np.integer)) or top_n < 1:
+        raise ValueError(f"top_n must be a positive integer, got {top_n!r}")
+
+def _check_model(model):
+    if not isinstance(model, str) or model not in MODELS:
+        raise ValueError(f"model must be one of {MODELS}, got {model!r}")
+
+def _check_user_id(user_id):
+    if isinstance(user_id, bool) or not isinstance(user_id, (int, float, str, np.generic)):
+        raise ValueError(f"user_id must be a scalar id, got {user_id!r}")
+
+def _to_json(result):
+    return [[np.asarray(item_id).item(), float(score)] for item_id, score in result]
+
+if __name__ == "__main__":
+    pass
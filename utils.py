@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Các hàm dùng chung cho việc xếp hạng top-N trên ma trận điểm và công thức dự đoán của MF.
+"""
+
+import numpy as np
+
+def mask_seen(scores, seen_rows):
+    """
+    Gán -inf cho các items người dùng đã đánh giá.
+
+    Parameters:
+    - scores: ma trận điểm (n_users_batch, n_items), bị sửa trực tiếp
+    - seen_rows: csr_matrix (n_users_batch, n_items) đánh dấu các items đã thấy
+    """
+    rows = np.repeat(np.arange(seen_rows.shape[0]), np.diff(seen_rows.indptr))
+    scores[rows, seen_rows.indices] = -np.inf
+    return scores
+
+def top_n_indices(scores, top_n):
+    """
+    Lấy chỉ số top-N theo từng hàng bằng argpartition, sắp xếp giảm dần.
+
+    Parameters:
+    - scores: ma trận điểm (n_users_batch, n_items)
+    - top_n: số items cần lấy
+
+    Returns:
+    - list các mảng chỉ số, bỏ qua các vị trí có điểm -inf hoặc NaN
+    """
+    n_items = scores.shape[1]
+    k = min(top_n, n_items)
+    if k <= 0:
+        return [np.empty(0, dtype=np.int64) for _ in range(scores.shape[0])]
+
+    scores = np.where(np.isnan(scores), -np.inf, scores)
+    if k < n_items:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(n_items), scores.shape)
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1, kind='stable')
+    candidates = np.take_along_axis(candidates, order, axis=1)
+    candidate_scores = np.take_along_axis(candidate_scores, order, axis=1)
+
+    return [row[np.isfinite(row_scores)] for row, row_scores in zip(candidates, candidate_scores)]
+
+def mf_estimate(user_idx, item_idx, pu, qi, bu, bi, global_mean, biased, rating_scale):
+    """
+    Dự đoán MF cho các cặp (user, item), cùng công thức với SVD.estimate của surprise:
+    mu + bu + bi + qi·pu, bỏ các thành phần của user/item chưa biết, rồi cắt về rating_scale.
+    Dùng chung bởi MatrixFactorizationRecommender.predict_batch và các worker Co-Training.
+
+    Parameters:
+    - user_idx, item_idx: chỉ số hàng trong pu / qi, -1 nếu chưa biết
+    - pu, qi, bu, bi, global_mean, biased, rating_scale: tham số của mô hình
+
+    Returns:
+    - np.ndarray điểm dự đoán
+    """
+    known_user = user_idx >= 0
+    known_item = item_idx >= 0
+    both = known_user & known_item
+    dot = np.einsum('ij,ij->i', qi[item_idx[both]], pu[user_idx[both]])
+
+    est = np.full(len(user_idx), global_mean)
+    if biased:
+        est[known_user] += bu[user_idx[known_user]]
+        est[known_item] += bi[item_idx[known_item]]
+        est[both] += dot
+    else:
+        # SVD không bias: chỉ dự đoán được khi biết cả user và item, còn lại dùng global_mean
+        est[both] = dot
+
+    return np.clip(est, *rating_scale)
+
+def mf_scores(user_idx, pu, qi, bu, bi, global_mean, biased, rating_scale, known_items=None):
+    """
+    Điểm MF của một nhóm users với mọi hàng của qi, cùng công thức với mf_estimate.
+    Dùng chung bởi MatrixFactorizationRecommender.score_users và ServingModel.
+
+    Parameters:
+    - user_idx: chỉ số hàng trong pu, -1 nếu chưa biết
+    - known_items: (tùy chọn) mặt nạ các hàng của qi là item mô hình đã biết; các hàng còn lại
+      được chấm như item chưa biết. None là biết tất cả
+
+    Returns:
+    - np.ndarray (len(user_idx), len(qi))
+    """
+    user_idx = np.asarray(user_idx)
+    known = user_idx >= 0
+    user_factors = np.zeros((len(user_idx), pu.shape[1]))
+    user_factors[known] = pu[user_idx[known]]
+    dot = user_factors @ qi.T
+    if known_items is not None:
+        dot[:, ~known_items] = 0
+
+    if biased:
+        user_bias = np.zeros(len(user_idx))
+        user_bias[known] = bu[user_idx[known]]
+        item_bias = bi if known_items is None else np.where(known_items, bi, 0)
+        scores = (global_mean + user_bias)[:, None] + item_bias[None, :]
+        scores += dot
+    else:
+        scores = dot
+        scores[~known] = global_mean
+        if known_items is not None:
+            scores[:, ~known_items] = global_mean
+
+    return np.clip(scores, *rating_scale, out=scores)